@@ -0,0 +1,10 @@
+#!/bin/bash
+
+BASEDIR=`dirname $0`/..
+
+. $BASEDIR/triparchive_env/bin/activate
+
+export PYTHONPATH=$BASEDIR
+
+python -m gevent.monkey --module triptools.loadtest --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
+
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+BASEDIR=`dirname $0`/..
+
+. $BASEDIR/triparchive_env/bin/activate
+
+export PYTHONPATH=$BASEDIR
+
+python -m triptools.mapbench --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
+
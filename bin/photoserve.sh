@@ -6,6 +6,6 @@ BASEDIR=`dirname $0`/..
 
 export PYTHONPATH=$BASEDIR
 
-python -m triptools.photoserve --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
+python -m gevent.monkey --module triptools.photoserve --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
 
 
@@ -6,6 +6,6 @@ BASEDIR=`dirname $0`/..
 
 export PYTHONPATH=$BASEDIR
 
-python -m triptools.videoserve --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
+python -m gevent.monkey --module triptools.videoserve --basedir $BASEDIR --config $BASEDIR/config/triparchive.conf $*
 
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# triptools reads its configuration from the command line on import
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.argv = [sys.argv[0], "--basedir", BASEDIR,
+            "--config", os.path.join(BASEDIR, "config", "triparchive.conf")]
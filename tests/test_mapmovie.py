@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import pytest
+
+from triptools import config
+from triptools import mapmovie
+
+
+def test_interrupted_job_resumes(tmp_path, monkeypatch):
+    target = str(tmp_path / "movie.mp4")
+    targets = [(target, {})]
+    rendered = []
+    fail_at = [2]
+
+    def render_chunk(filename, track_points, track, start_time, chunk, chunk_targets):
+        num = len(rendered)
+        if num == fail_at[0]:
+            raise Exception("interrupted")
+        rendered.append(chunk)
+        for name, _ in chunk_targets:
+            open(name, "w").close()
+
+    def concat_chunks(parts, target_name, profile):
+        assert all(os.path.exists(part) for part in parts)
+        open(target_name, "w").close()
+
+    config.set("Video", "chunk_duration", "10")
+    config.set("Video", "chunk_jobs", "1")
+    monkeypatch.setattr(mapmovie, "fetch_keyframes", lambda filename: [(ts, 0) for ts in range(0, 60, 10)])
+    monkeypatch.setattr(mapmovie, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(mapmovie, "renderChunk", render_chunk)
+    monkeypatch.setattr(mapmovie, "concat_chunks", concat_chunks)
+
+    with pytest.raises(Exception, match="interrupted"):
+        mapmovie.renderChunked("video.mp4", [], None, 0, 60.0, targets)
+    assert rendered == [[0.0, 10.0], [10, 10]]
+
+    # the second run only renders the chunks missing after the first one
+    fail_at[0] = None
+    mapmovie.renderChunked("video.mp4", [], None, 0, 60.0, targets)
+    assert rendered == [[0.0, 10.0], [10, 10], [20, 10], [30, 10], [40, 10], [50, 10.0]]
+    assert os.path.exists(target)
+    assert not os.path.exists(target + ".parts")
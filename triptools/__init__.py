@@ -3,4 +3,7 @@ from .common import Trackpoint, Feature, distance
 from .db_impl import DB
 from .map_support import MapTool
 
-osm_mapper = MapTool(config.get("Map", "redis_host"))
+osm_mapper = MapTool(config.get("Map", "redis_host"),
+                     config.getfloat("Map", "tile_cache_mb"),
+                     config.get("Map", "mbtiles_file"),
+                     config.get("Map", "tile_url"))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+
+def make_key(*parts):
+    """Hex digest over the repr of all parts"""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode("utf8"))
+    return h.hexdigest()
+
+
+class FileCache:
+    """Directory of cached files with a size limit. The least recently
+    used files are removed first. An empty directory name disables the
+    cache."""
+
+    def __init__(self, directory, max_mb, suffix=""):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.suffix = suffix
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the name of the cached file or None"""
+        if not self.enabled:
+            return None
+        name = self.path(key)
+        try:
+            os.utime(name)
+        except FileNotFoundError:
+            return None
+        logging.getLogger(__name__).info("Cache hit for %s" % name)
+        return name
+
+    def put(self, key, filename):
+        """Move filename into the cache and return its new name. If the
+        cache is disabled, filename is returned unchanged."""
+        if not self.enabled:
+            return filename
+        name = self.path(key)
+        tmp_name = "%s.%d.%d.tmp" % (name, os.getpid(), threading.get_ident())
+        shutil.move(filename, tmp_name)
+        os.replace(tmp_name, name)
+        self.evict(keep=name)
+        return name
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the size limit is met"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.suffix) and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(name)
+                logging.getLogger(__name__).info("Evicted %s from cache" % name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class RenderCache:
+    """Rendered responses by key. An in-process LRU bounded by bytes sits
+    in front of an optional redis shared by all server processes. Entries
+    expire after ttl seconds in both. Concurrent misses for the same key
+    wait for a single render."""
+
+    def __init__(self, max_mb, ttl, client=None, prefix="render:"):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.client = client
+        self.prefix = prefix
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def get_local(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.size -= len(data)
+                return None
+            self.entries.move_to_end(key)
+            return data
+
+    def put_local(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (time.monotonic() + self.ttl, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, key):
+        data = self.get_local(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        if self.client is not None:
+            data = self.client.get(self.prefix + key)
+            if data is not None:
+                self.shared_hits += 1
+                self.put_local(key, data)
+                return data
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self.put_local(key, data)
+        if self.client is not None:
+            self.client.setex(self.prefix + key, self.ttl, data)
+
+    def cached(self, key, render):
+        """Cached data for key, render() returns it on a miss"""
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.result()
+
+        try:
+            # a render may have finished between get and taking the lead
+            data = self.get_local(key)
+            if data is None:
+                data = render()
+                self.put(key, data)
+            flight.set_result(data)
+            return data
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "shared_hits": self.shared_hits,
+                    "misses": self.misses,
+                    "coalesced": self.coalesced,
+                    "inflight": len(self.inflight),
+                    "entries": len(self.entries),
+                    "mb": round(self.size / 1024 / 1024, 1)}
+
+
+class DataVersion:
+    """Version counter of a kind of data in the DB, bumped by importers.
+    It is read again at most every interval seconds."""
+
+    def __init__(self, db, name, interval):
+        self.db = db
+        self.name = name
+        self.interval = interval
+        self.version = None
+        self.checked = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.version is None or now - self.checked > self.interval:
+            self.version = self.db.get_data_version(self.name)
+            self.checked = now
+        return self.version
@@ -108,6 +108,25 @@ class Feature:
         return self.__str__()
 
 
+class PhotoCluster:
+    """Photos aggregated into one map grid cell"""
+
+    def __init__(self, count, ids, longitude, latitude):
+        self.count = count
+        self.ids = ids
+        self.longitude = longitude
+        self.latitude = latitude
+
+    def __str__(self):
+        return "(%d photos: lon:%f lat:%f ids:%s)" % (self.count,
+                                                      self.longitude,
+                                                      self.latitude,
+                                                      self.ids)
+
+    def __repr__(self):
+        return self.__str__()
+
+
 # approx earth radius in m
 EARTH_RADIUS = 6371000.0
 
@@ -124,6 +143,17 @@ def distance(lon1, lat1, lon2, lat2):
     c = 2*math.atan2(math.sqrt(a), math.sqrt(1-a))
     return EARTH_RADIUS*c
 
+def distances(lons, lats):
+    """Approx distances in meter between consecutive points of lon/lat
+    arrays, one element shorter than the input"""
+    rlons = np.radians(np.asarray(lons, dtype=float))
+    rlats = np.radians(np.asarray(lats, dtype=float))
+    dlon = np.diff(rlons)
+    dlat = np.diff(rlats)
+    a = np.sin(dlat/2)**2 + np.cos(rlats[:-1])*np.cos(rlats[1:])*np.sin(dlon/2)**2
+    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return EARTH_RADIUS*c
+
 def tp_dist(tp1, tp2):
     return distance(tp1.longitude, tp1.latitude, tp2.longitude, tp2.latitude)
 
@@ -3,6 +3,7 @@ from functools import lru_cache
 import hashlib
 import json
 import logging
+import math
 import psycopg2
 from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extras import Json
@@ -10,10 +11,20 @@ import re
 from types import MethodType
 
 from triptools import config
-from triptools.common import Trackpoint, Feature, distance
+from triptools.common import Trackpoint, Feature, PhotoCluster, distance
 
 logging.basicConfig(level=logging.INFO)
 
+# Web Mercator (EPSG:3857) sphere radius and world width in m
+MERCATOR_RADIUS = 6378137.0
+MERCATOR_WORLD = 2 * math.pi * MERCATOR_RADIUS
+
+def mercator(lon, lat):
+    """lon/lat in Web Mercator meters"""
+    lat = max(min(lat, 85.051129), -85.051129)
+    return (MERCATOR_RADIUS * math.radians(lon),
+            MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+
 class ConnWrap:
     """Wrapper for connections to support pool"""
 
@@ -53,6 +64,11 @@ class DB:
                 # videos
                 c.execute("CREATE TABLE IF NOT EXISTS videos (id SERIAL PRIMARY KEY, filename text, starttime int8, duration float )")
                 c.execute("CREATE UNIQUE INDEX IF NOT EXISTS filename_ux ON videos (filename)")
+                c.execute("ALTER TABLE videos ADD COLUMN IF NOT EXISTS moov_offset int8")
+                c.execute("ALTER TABLE videos ADD COLUMN IF NOT EXISTS moov_size int8")
+
+                # keyframes, pts in seconds from the start of the video
+                c.execute("CREATE TABLE IF NOT EXISTS keyframes (video_id int references videos(id), pts float, pos int8, PRIMARY KEY (video_id, pts))")
                 
                 #videopoints
                 c.execute("CREATE TABLE IF NOT EXISTS videopoints (video_id int references videos(id), timepoint int8, altitude float, location geography(Point,4326), PRIMARY KEY (video_id, timepoint))")
@@ -63,10 +79,28 @@ class DB:
                 c.execute("CREATE UNIQUE INDEX IF NOT EXISTS photos_id_ux ON photos (id)")
                 c.execute("CREATE UNIQUE INDEX IF NOT EXISTS photos_hash_ux ON photos (hash)")
                 
+                # data versions, bumped by importers to invalidate caches
+                c.execute("CREATE TABLE IF NOT EXISTS data_versions (name text PRIMARY KEY, version int8)")
+
                 # geonetnames
                 c.execute("CREATE TABLE IF NOT EXISTS geonetnames (name text, location geography(Point,4326), feature text, country text)")
                 c.execute("CREATE INDEX IF NOT EXISTS geonetnames_location_idx ON geonetnames USING GIST (location)")
 
+    def get_data_version(self, name):
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT version FROM data_versions WHERE name = %s", (name,))
+                row = c.fetchone()
+                return row[0] if row else 0
+
+    def bump_data_version(self, name):
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("INSERT INTO data_versions (name, version) VALUES (%s, 1) "
+                          "ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1 RETURNING version",
+                          (name,))
+                return c.fetchone()[0]
+
     def __enter__(self):
         return self
                 
@@ -228,6 +262,76 @@ class DB:
                 c.execute("select timepoint, ST_X(location::geometry), ST_Y(location::geometry), altitude, video_id from videopoints where video_id in ('" + "','".join(map(str, video_ids)) + "') order by video_id, timepoint")
                 track += [ DB.from_videopoint(row) for row in c]
         return track
+
+    def fetch_video_overview(self, video_ids, interval):
+        """First videopoint of every interval seconds of the videos"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT DISTINCT ON (video_id, timepoint / %s) "
+                          "timepoint, ST_X(location::geometry), ST_Y(location::geometry), altitude, video_id FROM videopoints "
+                          "WHERE video_id = ANY(%s) "
+                          "ORDER BY video_id, timepoint / %s, timepoint",
+                          (interval, list(video_ids), interval))
+                return [DB.from_videopoint(row) for row in c]
+
+    def fetch_videopoints_bb(self, video_ids, min_x, min_y, max_x, max_y):
+        """Videopoints of the videos within a bounding box"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT timepoint, ST_X(location::geometry), ST_Y(location::geometry), altitude, video_id FROM videopoints "
+                          "WHERE video_id = ANY(%s) AND location && ST_MakeEnvelope(%s, %s, %s, %s, 4326) "
+                          "ORDER BY video_id, timepoint",
+                          (list(video_ids), min_x, min_y, max_x, max_y))
+                return [DB.from_videopoint(row) for row in c]
+
+    def set_video_index(self, video_id, moov, keyframes):
+        """Store the (offset, size) of the moov box or None and the
+        (pts, byte offset) of the keyframes of a video"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("UPDATE videos SET moov_offset = %s, moov_size = %s WHERE id = %s",
+                          (moov[0] if moov else None, moov[1] if moov else None, video_id))
+                c.execute("DELETE FROM keyframes WHERE video_id = %s", (video_id,))
+                c.executemany("INSERT INTO keyframes (video_id, pts, pos) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                              [(video_id, pts, pos) for pts, pos in keyframes])
+
+    def has_video_index(self, video_id):
+        """True if the keyframes of a video are recorded"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT EXISTS (SELECT 1 FROM keyframes WHERE video_id = %s)", (video_id,))
+                return c.fetchone()[0]
+
+    def get_video_moov(self, video_id):
+        """(offset, size) of the moov box of a video, None if unknown"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT moov_offset, moov_size FROM videos WHERE id = %s", (video_id,))
+                row = c.fetchone()
+                return (row[0], row[1]) if row and row[0] is not None else None
+
+    def get_keyframe(self, video_id, offset):
+        """(pts, byte offset) of the last keyframe at or before offset
+        seconds, None if the video has no keyframe index"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT pts, pos FROM keyframes WHERE video_id = %s AND pts <= %s "
+                          "ORDER BY pts DESC LIMIT 1",
+                          (video_id, offset))
+                return c.fetchone()
+
+    def get_closest_videopoint(self, lon, lat, video_ids):
+        """Videopoint of the given videos closest to lon/lat, found by a
+        nearest neighbour search on the location index"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT timepoint, ST_X(location::geometry), ST_Y(location::geometry), altitude, video_id FROM videopoints "
+                          "WHERE video_id = ANY(%s) "
+                          "ORDER BY location <-> ST_SetSRID(ST_Point(%s, %s), 4326)::geography "
+                          "LIMIT 1",
+                          (list(video_ids), lon, lat))
+                row = c.fetchone()
+                return DB.from_videopoint(row) if row else None
     
     #
     # photo support
@@ -290,6 +394,42 @@ class DB:
                           (min_x, min_y, max_x, max_y, sort_x, sort_y, limit))
                 return [DB.from_photo(row) for row in c]
 
+    def get_thumbnails(self, ids):
+        """Thumbnails of the photos with the given ids by id"""
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT id, thumbnail FROM photos WHERE id = ANY(%s)", (list(ids),))
+                return {row[0]: bytes(row[1]) if row[1] else None for row in c}
+
+    @staticmethod
+    def from_photo_cluster(row):
+        return PhotoCluster(row[0], row[1], row[2], row[3])
+
+    def get_photo_clusters(self, min_x, min_y, max_x, max_y, zoom, cell_size=32, ids=5):
+        """Photos within the bounding box aggregated into grid cells of
+        cell_size pixels at zoom, with count, the ids of the latest photos
+        and the centroid per cell. Cells are aligned to the Web Mercator
+        pixel grid and the box is widened to whole cells, so adjacent
+        boxes never split a cell."""
+        cell = MERCATOR_WORLD / (256 * 2 ** zoom) * cell_size
+        x1, y1 = mercator(min_x, min_y)
+        x2, y2 = mercator(max_x, max_y)
+        with self.getconn() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT n, ids, ST_X(center), ST_Y(center) FROM "
+                          "(SELECT count(*) AS n, (array_agg(id ORDER BY timepoint DESC))[1:%(ids)s] AS ids, "
+                          "ST_Transform(ST_Centroid(ST_Collect(geom)), 4326) AS center FROM "
+                          "(SELECT id, timepoint, ST_Transform(location::geometry, 3857) AS geom FROM photos "
+                          "WHERE location && ST_Transform(ST_MakeEnvelope(%(x1)s, %(y1)s, %(x2)s, %(y2)s, 3857), 4326)::geography) p "
+                          "GROUP BY floor(ST_X(geom) / %(cell)s), floor(ST_Y(geom) / %(cell)s)) clusters",
+                          {"x1": math.floor(x1 / cell) * cell,
+                           "y1": math.floor(y1 / cell) * cell,
+                           "x2": math.ceil(x2 / cell) * cell,
+                           "y2": math.ceil(y2 / cell) * cell,
+                           "cell": cell,
+                           "ids": ids})
+                return [DB.from_photo_cluster(row) for row in c]
+
     def get_photos_at(self, center_x, center_y, limit = 10):
         with self.getconn() as conn:
             with conn.cursor() as c:
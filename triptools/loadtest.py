@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Requests per second of a running photoserve or videoserve with many
+concurrent clients."""
+
+import logging
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import gevent
+from gevent import monkey
+
+from triptools import config
+
+logging.basicConfig(level=logging.INFO)
+
+def fetch(url):
+    """HTTP status of url, its body is read completely"""
+    try:
+        with urllib.request.urlopen(url) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def run_load(server, paths, clients, requests):
+    if not monkey.is_module_patched("socket"):
+        raise Exception("Run the load test with python -m gevent.monkey --module")
+    latencies = []
+    statuses = {}
+    remaining = [requests]
+
+    def client(idx):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            url = server + paths[(idx + remaining[0]) % len(paths)]
+            start = time.perf_counter()
+            status = fetch(url)
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(client, idx) for idx in range(clients)], raise_error=True)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    log = logging.getLogger(__name__)
+    log.info("%d requests by %d clients in %.2f s: %.1f requests/s" %
+             (len(latencies), clients, elapsed, len(latencies) / elapsed))
+    log.info("Latency median %.1f ms, 95%% %.1f ms, max %.1f ms" %
+             (1000 * latencies[len(latencies) // 2],
+              1000 * latencies[int(len(latencies) * 0.95)],
+              1000 * latencies[-1]))
+    log.info("Status codes: %s" % statuses)
+
+if __name__ == "__main__":
+
+    try:
+        run_load(config.get("Loadtest", "server").rstrip("/"),
+                 [p.strip() for p in config.get("Loadtest", "paths").split(",") if p.strip()],
+                 config.getint("Loadtest", "clients"),
+                 config.getint("Loadtest", "requests"))
+    except Exception as e:
+        logging.getLogger(__name__).error(e, exc_info=True)
+        sys.exit(1)
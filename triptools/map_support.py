@@ -2,32 +2,254 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+from collections import OrderedDict
+import os
 import redis
+import threading
 import geotiler
+from geotiler.provider import MapProvider
 import cairocffi as cairo
-from geotiler.cache import redis_downloader
+import numpy as np
+
+from triptools.common import EARTH_RADIUS, dist_to_deg, distances
+from triptools.tile_support import (TileCache, TileFetcher, TileUrlParser, RedisTileStore, MBTilesStore,
+                                    decode_tile, render_tiles, corridor_tiles, bbox_tiles, prefetch_tiles,
+                                    world_pixels, world_lonlat, map_surface)
+
+# track points further apart start a new line
+TRACK_GAP = 1000
+TRACK_WIDTH = 2
+# max deviation in pixels of a simplified track
+TRACK_TOLERANCE = 0.5
+MAX_TILE_ZOOM = 19
+
+
+def simplify(x, y, tolerance, fixed):
+    """Douglas-Peucker simplification. Returns a mask of the points to
+    keep, so that no point is further than tolerance from the simplified
+    line. Sections between consecutive fixed indices are simplified
+    separately."""
+    keep = np.zeros(len(x), dtype=bool)
+    keep[fixed] = True
+    stack = list(zip(fixed[:-1], fixed[1:]))
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first+1:last] - x[first], y[first+1:last] - y[first]
+        norm = dx * dx + dy * dy
+        # distance to the segment, not to the infinite line, keeps turnarounds
+        t = np.clip((px * dx + py * dy) / norm, 0.0, 1.0) if norm > 0 else 0.0
+        dist = np.hypot(px - t * dx, py - t * dy)
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            mid = first + 1 + idx
+            keep[mid] = True
+            stack.append((first, mid))
+            stack.append((mid, last))
+    return keep
+
+
+class TrackLevels:
+    """Track simplified for each map zoom, so drawing cost depends on the
+    map size and not on the number of points. Levels are computed on
+    first use and kept."""
+
+    def __init__(self, trackPoints, tolerance=TRACK_TOLERANCE, tile_size=256):
+        self.lons = np.fromiter((tp.longitude for tp in trackPoints), dtype=float, count=len(trackPoints))
+        self.lats = np.fromiter((tp.latitude for tp in trackPoints), dtype=float, count=len(trackPoints))
+        self.tolerance = tolerance
+        # world pixels at zoom 0, zoom z scales them by 2**z
+        self.x, self.y = world_pixels(self.lons, self.lats, 0, tile_size)
+        self.starts = np.ones(len(self.lons), dtype=bool)
+        self.starts[1:] = distances(self.lons, self.lats) >= TRACK_GAP
+        starts = np.flatnonzero(self.starts)
+        self.fixed = np.unique(np.concatenate((starts, starts[1:] - 1, [len(self.lons) - 1]))).astype(int)
+        # typical distance between points at zoom 0
+        self.spacing = float(np.median(np.hypot(np.diff(self.x), np.diff(self.y)))) if len(self.x) > 1 else 0.0
+        self.levels = {}
+
+    def __len__(self):
+        return len(self.lons)
+
+    def level(self, zoom):
+        """(lons, lats, starts) of the track for zoom. starts marks the
+        first point of each line."""
+        if zoom not in self.levels:
+            self.levels[zoom] = self.simplify(zoom)
+        return self.levels[zoom]
+
+    def simplify(self, zoom):
+        scale = 2.0 ** zoom
+        if len(self) < 3 or self.spacing * scale >= self.tolerance:
+            # nothing to remove or points are already further apart than the tolerance
+            keep = slice(None)
+        else:
+            keep = simplify(self.x * scale, self.y * scale, self.tolerance, self.fixed)
+        return self.lons[keep], self.lats[keep], self.starts[keep]
+
+
+class TrackRegions:
+    """Full resolution track loaded on demand for the tiles of zoom
+    region_zoom a map covers. load(lon1, lat1, lon2, lat2) returns the
+    trackpoints within a bounding box. The TrackLevels of the
+    max_regions most recently used regions are kept."""
+
+    def __init__(self, load, region_zoom, max_regions, tile_size=256):
+        self.load = load
+        self.region_zoom = region_zoom
+        self.max_regions = max_regions
+        self.tile_size = tile_size
+        self.regions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def bounds(self, x, y):
+        """lon1, lat1, lon2, lat2 of region x, y"""
+        lons, lats = world_lonlat([x * self.tile_size, (x + 1) * self.tile_size],
+                                  [(y + 1) * self.tile_size, y * self.tile_size],
+                                  self.region_zoom, self.tile_size)
+        return lons[0], lats[0], lons[1], lats[1]
+
+    def covering(self, map_tile):
+        """Regions x, y overlapping the map"""
+        lon1, lat1, lon2, lat2 = map_tile.extent
+        return sorted((x, y) for _, x, y in bbox_tiles(((lon1, lat1), (lon2, lat2)), self.region_zoom, self.tile_size))
+
+    def get(self, x, y):
+        """TrackLevels of region x, y"""
+        with self.lock:
+            levels = self.regions.get((x, y))
+            if levels is not None:
+                self.regions.move_to_end((x, y))
+                self.hits += 1
+                return levels
+
+        # lines leaving the region and coming back closer than TRACK_GAP
+        # must not be joined inside of it, so load a margin of TRACK_GAP
+        lon1, lat1, lon2, lat2 = self.bounds(x, y)
+        margin = dist_to_deg(TRACK_GAP)
+        lon_margin = margin / max(np.cos(np.radians(max(abs(lat1), abs(lat2)))), 0.01)
+        levels = TrackLevels(self.load(lon1 - lon_margin, lat1 - margin, lon2 + lon_margin, lat2 + margin))
+
+        with self.lock:
+            self.loads += 1
+            self.regions[(x, y)] = levels
+            while len(self.regions) > self.max_regions:
+                self.regions.popitem(last=False)
+        return levels
+
+    def stats(self):
+        with self.lock:
+            return {"regions": len(self.regions), "hits": self.hits, "loads": self.loads}
+
+
+class MapMosaic:
+    """Large pre-rendered map. Frames of a fixed size are cropped from
+    it instead of rendering a new map for every position."""
+
+    def __init__(self, map_tile, surface):
+        self.map_tile = map_tile
+        self.surface = surface
+
+    @property
+    def size(self):
+        return self.map_tile.size
+
+    def get_centered_surface(self, lon, lat, size, surface=None):
+        """Crop a surface of the given size centered around lon/lat,
+        painted into surface if it has that size"""
+        width, height = size
+        x, y = self.map_tile.rev_geocode((lon, lat))
+        surface = map_surface(size, surface)
+        cr = cairo.Context(surface)
+        # replaces the previous frame, also outside of the mosaic
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        # integer offsets keep this a plain copy without resampling
+        cr.set_source_surface(self.surface, round(width / 2 - x), round(height / 2 - y))
+        cr.paint()
+        return surface
 
-from triptools.common import EARTH_RADIUS, dist_to_deg, tp_dist
 
 class MapTool:
 
-    def __init__(self, redis_host):
-        client = redis.Redis(redis_host)
-        self.downloader = redis_downloader(client, timeout=86400 * 356) # cache for 1 year
-        
-    @staticmethod
-    def fix_async_io_event_loop():
-        """create default event loop, required if run e.g. from flask"""
-        try:
-            event_loop = asyncio.get_event_loop()
-        except:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+    def __init__(self, redis_host, tile_cache_mb=64, mbtiles_file=None, tile_url=None):
+        """Tile data is stored in mbtiles_file if given, otherwise in
+        redis. tile_url replaces the OSM tile server, e.g.
+        http://localhost:8000/{z}/{x}/{y}.png"""
+        if tile_url:
+            self.provider = MapProvider({"id": "custom", "name": "custom", "url": tile_url, "limit": 2})
+        else:
+            self.provider = geotiler.find_provider("osm")
+        self.parser = TileUrlParser(self.provider)
+        if mbtiles_file:
+            self.store = MBTilesStore(mbtiles_file, self.parser)
+        else:
+            self.store = RedisTileStore(redis.Redis(redis_host), timeout=86400 * 356) # cache for 1 year
+        # decoded tiles in memory first, then the tile store, then the tile server
+        self.tile_cache = TileCache(tile_cache_mb)
+        self.loop_lock = threading.Lock()
+        self.loop = None
+        self.loop_pid = None
+        self.fetcher = None
 
-    @staticmethod
-    def as_surface(image):
-        buff = bytearray(image.convert('RGBA').tobytes('raw', 'BGRA'))
-        return cairo.ImageSurface.create_for_data(buff, cairo.FORMAT_ARGB32, image.size[0], image.size[1])
+    def get_loop(self):
+        """Event loop running on a background thread, shared by all map
+        requests. A forked process starts its own loop."""
+        with self.loop_lock:
+            if self.loop is None or self.loop_pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                self.loop_pid = os.getpid()
+                self.fetcher = TileFetcher(self.provider.limit)
+                threading.Thread(target=self.loop.run_forever, name="MapTool", daemon=True).start()
+            return self.loop
+
+    def run(self, coro):
+        """Run a coroutine on the map event loop and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop()).result()
+
+    def get_tiles(self, map_tile):
+        """Tiles of a map with decoded images. Tiles are taken from the
+        tile cache or the tile store, only the rest is downloaded."""
+        tiles = geotiler.fetch_tiles(map_tile, downloader=lambda tiles, num_workers: list(tiles))
+        result = []
+        missing = []
+        for tile in tiles:
+            image = self.tile_cache.get(self.parser.key(tile.url))
+            if image is not None:
+                result.append(tile._replace(img=image))
+                continue
+            data = self.store.get(tile.url)
+            if data is None:
+                missing.append(tile)
+            else:
+                result.append(tile._replace(img=data))
+
+        if missing:
+            self.get_loop()
+            downloaded = self.run(self.fetcher.download(missing, self.provider.limit))
+            for tile in downloaded:
+                if tile.img is not None:
+                    self.store.set(tile.url, tile.img)
+            result += downloaded
+
+        for idx, tile in enumerate(result):
+            if isinstance(tile.img, bytes):
+                try:
+                    image = decode_tile(tile.img)
+                    self.tile_cache.put(self.parser.key(tile.url), image)
+                    result[idx] = tile._replace(img=image)
+                except OSError as e:
+                    result[idx] = tile._replace(img=None, error=e)
+        return result
+
+    def stats(self):
+        stats = {"tiles": self.tile_cache.stats()}
+        if self.fetcher:
+            stats["downloads"] = self.fetcher.stats()
+        return stats
 
     @staticmethod
     def get_bounding_box(track, margin_pct=0.1, margin_km=0.2):
@@ -50,44 +272,143 @@ class MapTool:
         marg_lat = compute_margin(min_lat, max_lat, margin_pct, margin_km)
         return ( (min_lon - marg_lon, min_lat - marg_lat), (max_lon + marg_lon, max_lat + marg_lat) )
 
-    def get_map_from_bb(self, bb, size):
-        MapTool.fix_async_io_event_loop()
+    def render_map(self, map_tile, surface=None):
+        """Cairo surface with the map, painted into surface if it has the
+        right size"""
+        return render_tiles(map_tile, self.get_tiles(map_tile), surface)
+
+    def bb_map(self, bb, size):
+        """Map covering bb without rendering it"""
         lb,ru = bb
-        map_tile = geotiler.Map(extent=(lb[0], lb[1], ru[0],ru[1]), size=size)
-        image = geotiler.render_map(map_tile, downloader = self.downloader)
-        return map_tile, image
+        return geotiler.Map(extent=(lb[0], lb[1], ru[0],ru[1]), size=size, provider=self.provider)
+
+    def centered_map(self, lon, lat, zoom, size):
+        """Map centered around lon/lat without rendering it"""
+        return geotiler.Map(center=(lon, lat), zoom=zoom, size=size, provider=self.provider)
+
+    def get_map_from_bb(self, bb, size):
+        map_tile = self.bb_map(bb, size)
+        surface = self.render_map(map_tile)
+        return map_tile, surface
         
-    def get_centered_map(self, lon, lat, zoom, size):
-        MapTool.fix_async_io_event_loop()
-        map_tile = geotiler.Map(center=(lon, lat), zoom=zoom, size=size)
-        image = geotiler.render_map(map_tile, downloader = self.downloader)
-        return map_tile, image
+    def get_centered_map(self, lon, lat, zoom, size, surface=None):
+        map_tile = self.centered_map(lon, lat, zoom, size)
+        surface = self.render_map(map_tile, surface)
+        return map_tile, surface
+
+    @staticmethod
+    def valid_tile(zoom, x, y):
+        return 0 <= zoom <= MAX_TILE_ZOOM and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom
+
+    def tile_map(self, zoom, x, y):
+        """Map covering exactly the slippy map tile x/y at zoom"""
+        if not MapTool.valid_tile(zoom, x, y):
+            raise Exception("Invalid tile %d/%d/%d" % (zoom, x, y))
+        size = self.provider.tile_width
+        (lon,), (lat,) = world_lonlat([(x + 0.5) * size], [(y + 0.5) * size], zoom, size)
+        return geotiler.Map(center=(lon, lat), zoom=zoom, size=(size, size), provider=self.provider)
+
+    def get_tile_map(self, zoom, x, y):
+        map_tile = self.tile_map(zoom, x, y)
+        surface = self.render_map(map_tile)
+        return map_tile, surface
+
+    @staticmethod
+    def get_mosaic_size(bb, zoom, size):
+        """Size in pixels of a mosaic for get_mosaic"""
+        lb, ru = bb
+        map_tile = geotiler.Map(extent=(lb[0], lb[1], ru[0], ru[1]), zoom=zoom)
+        w, h = map_tile.size
+        return map_tile.center, (w + size[0], h + size[1])
+
+    def get_mosaic(self, bb, zoom, size):
+        """Render a map covering bb at a fixed zoom. The map is enlarged by
+        size, so each frame of that size centered inside bb can be cropped
+        from it."""
+        center, mosaic_size = MapTool.get_mosaic_size(bb, zoom, size)
+        map_tile = geotiler.Map(center=center, zoom=zoom, size=mosaic_size, provider=self.provider)
+        return MapMosaic(map_tile, self.render_map(map_tile))
+
+    def prefetch(self, tiles, requests):
+        """Fill the tile store with a set of (zoom, x, y) tiles"""
+        urls = [self.provider.tile_url((x, y), zoom) for zoom, x, y in sorted(tiles)]
+        self.get_loop()
+        return self.run(prefetch_tiles(self.store, urls, requests, downloader=self.fetcher))
+
+    def track_tiles(self, track, min_zoom, max_zoom, corridor):
+        """Set of (zoom, x, y) tiles within corridor pixels of the track
+        for each zoom in min_zoom..max_zoom"""
+        lons = [tp.longitude for tp in track]
+        lats = [tp.latitude for tp in track]
+        tiles = set()
+        for zoom in range(min_zoom, max_zoom + 1):
+            tiles |= corridor_tiles(lons, lats, zoom, corridor, self.provider.tile_width)
+        return tiles
+
+    def bb_tiles(self, bb, min_zoom, max_zoom):
+        """Set of (zoom, x, y) tiles covering bb for each zoom in
+        min_zoom..max_zoom"""
+        tiles = set()
+        for zoom in range(min_zoom, max_zoom + 1):
+            tiles |= bbox_tiles(bb, zoom, self.provider.tile_width)
+        return tiles
+
+    @staticmethod
+    def project(map_tile, lons, lats):
+        """Pixel coordinates of lon/lat arrays on map_tile, same as
+        rev_geocode for each point"""
+        tile_size = map_tile.provider.tile_width
+        (cx,), (cy,) = world_pixels([map_tile.center[0]], [map_tile.center[1]], map_tile.zoom, tile_size)
+        ox, oy = map_tile.rev_geocode(map_tile.center)
+        x, y = world_pixels(lons, lats, map_tile.zoom, tile_size)
+        return x + (ox - cx), y + (oy - cy)
 
     @staticmethod
     def draw_trackpoints(map_tile, surface, trackPoints):
+        MapTool.draw_track(map_tile, surface, TrackLevels(trackPoints))
 
-        if not trackPoints:
-            return
+    @staticmethod
+    def draw_regions(map_tile, surface, regions):
+        """Draw the TrackRegions covering the map, each clipped to its
+        region"""
+        for x, y in regions.covering(map_tile):
+            lon1, lat1, lon2, lat2 = regions.bounds(x, y)
+            (x1, x2), (y1, y2) = MapTool.project(map_tile, [lon1, lon2], [lat2, lat1])
+            MapTool.draw_track(map_tile, surface, regions.get(x, y), (x1, y1, x2 - x1, y2 - y1))
 
-        # draw track
-        cr = cairo.Context(surface)
+    @staticmethod
+    def draw_track(map_tile, surface, levels, clip=None):
+        """Draw the level of a TrackLevels matching the map zoom, only
+        within the clip rectangle (x, y, width, height) if given"""
 
-        t = 0.0
-        x1, y1 = map_tile.rev_geocode( (trackPoints[0].longitude, trackPoints[0].latitude) )
-        tp = trackPoints[0]
-        cr.move_to(x1, y1)
-        cr.set_line_width(2)
+        lons, lats, starts = levels.level(map_tile.zoom)
+        if len(lons) == 0:
+            return
 
-        t = 1.0
-        for t in trackPoints:
+        x, y = MapTool.project(map_tile, lons, lats)
 
-            x2, y2 = map_tile.rev_geocode( (t.longitude, t.latitude) )
-            if tp_dist(tp, t) < 1000:
-                cr.line_to(x2, y2)
-            else:
-                cr.move_to(x2, y2)
+        # segment i connects point i-1 with point i, keep those within a
+        # line and touching the viewport
+        w, h = map_tile.size
+        m = TRACK_WIDTH
+        x0, x1, y0, y1 = x[:-1], x[1:], y[:-1], y[1:]
+        segment = np.zeros(len(x) + 1, dtype=bool)
+        segment[1:-1] = (~starts[1:]
+                         & (np.minimum(x0, x1) <= w + m) & (np.maximum(x0, x1) >= -m)
+                         & (np.minimum(y0, y1) <= h + m) & (np.maximum(y0, y1) >= -m))
+        line_to = segment[:-1]
+        move_to = ~line_to & segment[1:]
 
-            x1, y1 = x2, y2
-            tp = t
+        # draw track
+        cr = cairo.Context(surface)
+        if clip is not None:
+            cr.rectangle(*clip)
+            cr.clip()
+        cr.set_line_width(TRACK_WIDTH)
+        for idx in np.flatnonzero(line_to | move_to):
+            if line_to[idx]:
+                cr.line_to(x[idx], y[idx])
+            else:
+                cr.move_to(x[idx], y[idx])
 
         cr.stroke()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare the former PIL based map frame rendering with painting cached
+Cairo tiles into a reused surface. Synthetic tiles are used, so nothing
+is downloaded. Memory is the peak of Python heap allocations per frame
+measured with tracemalloc, PIL and Cairo pixel buffers are not traced.
+Copied bytes are counted at every pixel copy of a frame: the visible
+part of each pasted tile and each full frame conversion."""
+
+import logging
+import sys
+import time
+import tracemalloc
+
+import cairocffi as cairo
+import geotiler
+import PIL.Image
+
+from triptools import config
+from triptools.tile_support import image_surface, render_tiles
+
+logging.basicConfig(level=logging.INFO)
+
+FRAMES = 200
+
+def frame_tiles(lon, lat, zoom, size):
+    """Map and its tiles without images"""
+    map_tile = geotiler.Map(center=(lon, lat), zoom=zoom, size=size)
+    tiles = geotiler.fetch_tiles(map_tile, downloader=lambda tiles, num_workers: list(tiles))
+    return map_tile, tiles
+
+def tile_bytes(map_tile, tiles):
+    """ARGB bytes of the tiles within the map"""
+    width, height = map_tile.size
+    provider = map_tile.provider
+    copied = 0
+    for tile in tiles:
+        x, y = tile.offset
+        w = min(x + provider.tile_width, width) - max(x, 0)
+        h = min(y + provider.tile_height, height) - max(y, 0)
+        copied += 4 * max(w, 0) * max(h, 0)
+    return copied
+
+def legacy_frame(map_tile, tiles, tile_image, surface):
+    """Former path: PIL mosaic, RGBA conversion, BGRA bytes and a
+    bytearray for Cairo. Returns the surface and the bytes copied."""
+    image = PIL.Image.new("RGBA", tuple(map_tile.size))
+    for tile in tiles:
+        image.paste(tile_image, tile.offset)
+    converted = image.convert('RGBA')
+    data = converted.tobytes('raw', 'BGRA')
+    buff = bytearray(data)
+    copied = (tile_bytes(map_tile, tiles) + 4 * converted.size[0] * converted.size[1]
+              + len(data) + len(buff))
+    return cairo.ImageSurface.create_for_data(buff, cairo.FORMAT_ARGB32, image.size[0], image.size[1]), copied
+
+def cairo_frame(map_tile, tiles, tile_surface, surface):
+    """Current path: cached tile surfaces painted into a reused surface.
+    Returns the surface and the bytes copied."""
+    surface = render_tiles(map_tile, [t._replace(img=tile_surface) for t in tiles], surface)
+    return surface, tile_bytes(map_tile, tiles)
+
+def measure(name, render, maps, tile):
+    """Render all maps, the surface of a frame is passed to the next one"""
+    seconds = 0.0
+    allocated = 0
+    copied = 0
+    surface = None
+    tracemalloc.start()
+    try:
+        for map_tile, tiles in maps:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            surface, frame_copied = render(map_tile, tiles, tile, surface)
+            seconds += time.perf_counter() - start
+            allocated += tracemalloc.get_traced_memory()[1] - base
+            copied += frame_copied
+    finally:
+        tracemalloc.stop()
+    logging.getLogger(__name__).info("%-8s %7.2f ms/frame %8.2f MB Python heap/frame %8.2f MB copied/frame" %
+                                     (name, 1000 * seconds / len(maps),
+                                      allocated / len(maps) / 1024 / 1024,
+                                      copied / len(maps) / 1024 / 1024))
+
+def run_benchmark(size, zoom, frames):
+    tile_image = PIL.Image.effect_noise((256, 256), 64).convert("RGBA")
+    tile_surface = image_surface(tile_image)
+    # a slowly moving center, as in a map movie
+    maps = [frame_tiles(10.0 + i * 0.0005, 50.0 + i * 0.0003, zoom, size) for i in range(frames)]
+
+    measure("legacy", legacy_frame, maps, tile_image)
+    measure("cairo", cairo_frame, maps, tile_surface)
+
+if __name__ == "__main__":
+
+    try:
+        run_benchmark((config.getint("Video", "map_width"), config.getint("Video", "map_height")),
+                      config.getint("Video", "map_zoom"),
+                      FRAMES)
+    except Exception as e:
+        logging.getLogger(__name__).error(e, exc_info=True)
+        sys.exit(1)
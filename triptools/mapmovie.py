@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
 import logging
 import os
 import cairocffi as cairo
@@ -17,8 +19,10 @@ from tqdm import tqdm
 from triptools import config
 from triptools import DB
 from triptools import osm_mapper
+from triptools.cache_support import FileCache, make_key
 from triptools.common import Track, Trackpoint, get_names, format_datetime, format_duration
 from triptools.configuration import MOVIE_PROFILE_PREFIX
+from triptools.video_support import fetch_keyframes
 
 logging.basicConfig(level=logging.INFO)
 
@@ -48,7 +52,67 @@ def cairoArrow(tipX, tailX, tipY, tailY, ctx):
 
     ctx.fill()
 
-    
+
+class CenteredMaps:
+    """Render a new map centered around each position"""
+
+    def __init__(self, zoom, size, positions):
+        self.zoom = zoom
+        self.size = size
+        # frames are written before the next one is rendered, so one
+        # surface is reused for all of them
+        self.surface = None
+        if config.getboolean("Video", "map_prefetch"):
+            # warm the tile cache, so rendering does not wait for downloads
+            tiles = osm_mapper.track_tiles(positions, zoom, zoom, max(size) // 2)
+            cached, fetched, failed = osm_mapper.prefetch(tiles, config.getint("Prefetch", "requests"))
+            logging.getLogger(__name__).info("Prefetched %d tiles, %d cached already, %d failed" % (fetched, cached, failed))
+
+    def get_surface(self, lon, lat):
+        _, self.surface = osm_mapper.get_centered_map(lon, lat, self.zoom, self.size, self.surface)
+        return self.surface
+
+
+class MosaicMaps:
+    """Crop each map from a mosaic covering the whole track"""
+
+    def __init__(self, mosaic, size):
+        self.mosaic = mosaic
+        self.size = size
+        self.surface = None
+
+    def get_surface(self, lon, lat):
+        self.surface = self.mosaic.get_centered_surface(lon, lat, self.size, self.surface)
+        return self.surface
+
+
+def map_source(positions, zoom, size):
+    """Select the map renderer configured in video_map_renderer"""
+    renderer = config.get("Video", "map_renderer")
+    if renderer == "mosaic":
+        bb = osm_mapper.get_bounding_box(positions,
+                                         config.getfloat("Map", "marg_pct"),
+                                         config.getfloat("Map", "marg_km"))
+        _, (w, h) = osm_mapper.get_mosaic_size(bb, zoom, size)
+        mosaic_mb = w * h * 4 / 1024 / 1024
+        if mosaic_mb <= config.getfloat("Video", "map_mosaic_max_mb"):
+            logging.getLogger(__name__).info("Rendering %dx%d map mosaic" % (w, h))
+            return MosaicMaps(osm_mapper.get_mosaic(bb, zoom, size), size)
+        logging.getLogger(__name__).warning("Map mosaic needs %dMB, rendering centered maps" % mosaic_mb)
+    elif renderer != "centered":
+        raise Exception("Unknown map renderer '%s'" % renderer)
+    return CenteredMaps(zoom, size, positions)
+
+# positions rounded to about 1m are considered equal
+POSITION_DIGITS = 5
+
+def link_frame(source, target):
+    """Reuse an already rendered frame file"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
 def makeMaps(filename, track, start_time, duration):
 
     MAP_FORMAT = "map%05d.png"
@@ -65,55 +129,77 @@ def makeMaps(filename, track, start_time, duration):
     db = DB()
 
     ticks = [t/framerate + start_time for t in range(int(duration * framerate)+1)]
+    positions = [track.get(t) for t in ticks]
+
+    maps = map_source(positions, zoom, (width, height))
     
-    for t in tqdm(ticks):
+    # frames with identical position, bearing and HUD text, e.g. while
+    # standing at a traffic light, reuse the previously rendered frame
+    previous_key = previous_frame = None
+    feature_pos = feature_name = None
+    reused = 0
 
-        tp = track.get(t)
-        
-        _, image = osm_mapper.get_centered_map(tp.longitude,
-                                               tp.latitude,
-                                               zoom,
-                                               (width, height))
+    for t, tp in tqdm(list(zip(ticks, positions))):
+
+        frame_name = os.path.join(dir_name, MAP_FORMAT % n)
+        position = (round(tp.longitude, POSITION_DIGITS), round(tp.latitude, POSITION_DIGITS))
+
+        # nearest Place
+        if position != feature_pos:
+            feature = db.get_nearest_feature(tp, features=["S", "P"])
+            feature_name = feature.name if feature else None
+            feature_pos = position
+
+        speed_text = "%6.1fkm/h" % track.speed(t)
+        altitude_text = "%6.1füNN" % tp.altitude
+        bearing_lon, bearing_lat = track.bearing(t)
+
+        key = (position, round(bearing_lon), round(bearing_lat), feature_name, speed_text, altitude_text)
+        if key == previous_key:
+            link_frame(previous_frame, frame_name)
+            reused += 1
+            n += 1
+            continue
 
         # cairo code
-        surface = osm_mapper.as_surface(image)
+        surface = maps.get_surface(tp.longitude, tp.latitude)
         cr = cairo.Context(surface)
 
-        # nearest Place
-        
-        feature = db.get_nearest_feature(tp, features=["S", "P"])
-        if feature:
+        if feature_name:
             cr.select_font_face("Courier");
             cr.move_to(10,70)
             cr.set_source_rgb(0, 0, 0) # black
             cr.set_font_size(17.0)
-            cr.show_text(feature.name)
+            cr.show_text(feature_name)
                         
         # speed indication
         cr.select_font_face("Courier");
         cr.move_to(10,30)
         cr.set_source_rgb(0, 0, 0) # black
         cr.set_font_size(17.0)
-        cr.show_text("%6.1fkm/h" % track.speed(t))
+        cr.show_text(speed_text)
 
         # altitude
         cr.move_to(10,50)
         cr.set_source_rgb(0, 0, 0) # black
         cr.set_font_size(17.0)
-        cr.show_text("%6.1füNN" % tp.altitude)
+        cr.show_text(altitude_text)
 
         # direction indication
         cr.move_to(width/2, height/2)
         cr.set_line_width(2)
-        bearing_lon, bearing_lat = track.bearing(t)
         cr.line_to(width/2 + bearing_lon, height/2 - bearing_lat)
         cr.stroke()
         cairoArrow(width/2 + bearing_lon, width/2, height/2 - bearing_lat, height/2, cr)
             
-        surface.write_to_png(os.path.join(dir_name, MAP_FORMAT % n))
+        surface.write_to_png(frame_name)
+        previous_key = key
+        previous_frame = frame_name
         
         n += 1
-        t += 1.0 / framerate
+
+    logging.getLogger(__name__).info("%d of %d map frames reused" % (reused, n))
+    logging.getLogger(__name__).info("Map tiles: %s" % osm_mapper.stats())
 
     rc = subprocess.call([ffmpeg.get_exe(), "-loglevel", "8", "-framerate", str(framerate),
                           "-i", os.path.join(dir_name, MAP_FORMAT),
@@ -129,27 +215,253 @@ def makeMaps(filename, track, start_time, duration):
     return map_movie_name
   
             
-def renderOverlay(filename, maps_movie, target_name, profile):
+# bump whenever makeMaps output changes to invalidate cached map movies
+MAP_RENDERER_VERSION = 2
+
+def map_movie_key(track_points, start_time, duration):
+    """Cache key for the map movie of a track and the map settings"""
+    return make_key([(tp.timestamp, tp.longitude, tp.latitude, tp.altitude) for tp in track_points],
+                    start_time,
+                    duration,
+                    config.getint("Video", "map_width"),
+                    config.getint("Video", "map_height"),
+                    config.getint("Video", "map_zoom"),
+                    config.getint("Video", "map_framerate"),
+                    MAP_RENDERER_VERSION)
+
+def map_cache():
+    return FileCache(config.get("Video", "map_cache_dir"),
+                     config.getfloat("Video", "map_cache_mb"),
+                     suffix=".avi")
+
+def cachedMaps(filename, track_points, track, start_time, duration):
+    """Fetch the map movie from the cache or render and cache it"""
+    cache = map_cache()
+    key = map_movie_key(track_points, start_time, duration)
+    maps_movie = cache.get(key)
+    if maps_movie is None:
+        maps_movie = cache.put(key, makeMaps(filename, track, start_time, duration))
+    return maps_movie
+
+MAP_OPACITY = 0.7
+
+def overlay_filter(video_filters):
+    """ffmpeg filter graph placing the map movie (input 1) transparently
+    in the top right corner of the camera clip (input 0). The result is
+    split into one stream [v0], [v1], ... per output, each with its own
+    optional video filter."""
+    graph = ("[1:v]format=rgba,colorchannelmixer=aa=%.2f[map];"
+             "[0:v][map]overlay=x=W-w:y=0:shortest=1" % MAP_OPACITY)
+    if len(video_filters) == 1:
+        if video_filters[0]:
+            graph += "," + video_filters[0]
+        return graph + "[v0]"
+    graph += ",split=%d" % len(video_filters)
+    graph += "".join("[s%d]" % i for i in range(len(video_filters)))
+    for i, video_filter in enumerate(video_filters):
+        graph += ";[s%d]%s[v%d]" % (i, video_filter or "null", i)
+    return graph
+
+def ffmpeg_output_args(profile):
+    """Translate a moviepy profile into ffmpeg output options. A video
+    filter given in ffmpeg_params is returned separately, as it has to
+    become part of the overlay filter graph."""
+    params = list(profile.get("ffmpeg_params", []))
+    video_filter = None
+    for opt in ("-vf", "-filter:v"):
+        while opt in params:
+            idx = params.index(opt)
+            video_filter = params[idx + 1]
+            del params[idx:idx + 2]
+
+    codec = profile.get("codec", "libx264")
+    args = ["-c:v", codec]
+    if "bitrate" in profile:
+        args += ["-b:v", profile["bitrate"]]
+    if "preset" in profile:
+        args += ["-preset", profile["preset"]]
+    if "fps" in profile:
+        args += ["-r", str(profile["fps"])]
+    if "threads" in profile:
+        args += ["-threads", str(profile["threads"])]
+    if codec == "libx264" and "-pix_fmt" not in params:
+        args += ["-pix_fmt", "yuv420p"]
+
+    if profile.get("audio", True) is False:
+        args += ["-an"]
+    else:
+        args += ["-c:a", profile.get("audio_codec", "libmp3lame")]
+        if "audio_bitrate" in profile:
+            args += ["-b:a", profile["audio_bitrate"]]
+        args += ["-ar", str(profile.get("audio_fps", 44100))]
+
+    return args + params, video_filter
+
+def clip_args(start, length):
+    """ffmpeg input options selecting a part of the camera clip"""
+    args = []
+    if start:
+        args += ["-ss", "%.3f" % start]
+    if length is not None:
+        args += ["-t", "%.3f" % length]
+    return args
+
+def renderOverlayFfmpeg(filename, maps_movie, targets, start=None, length=None):
+    """Decode and blend once, encode every (target_name, profile)"""
+    outputs = [ffmpeg_output_args(profile) for _, profile in targets]
+    args = ([ffmpeg.get_exe(), "-hide_banner", "-n"]
+            + clip_args(start, length)
+            + ["-i", filename,
+               "-i", maps_movie,
+               "-filter_complex", overlay_filter([vf for _, vf in outputs])])
+    for i, ((target_name, _), (output_args, _)) in enumerate(zip(targets, outputs)):
+        args += ["-map", "[v%d]" % i, "-map", "0:a?"] + output_args + [target_name]
+    logging.getLogger(__name__).debug("Running %s" % " ".join(map(shlex.quote, args)))
+    if subprocess.call(args) != 0:
+        raise Exception("ffmpeg failed to render %s" % ", ".join(t for t, _ in targets))
+
+def renderOverlayMoviepy(filename, maps_movie, targets, start=None, length=None):
     cam_clip = VideoFileClip(filename)
-    map_clip = VideoFileClip(maps_movie).set_opacity(0.7)
+    if start or length is not None:
+        cam_clip = cam_clip.subclip(start or 0, None if length is None else (start or 0) + length)
+    map_clip = VideoFileClip(maps_movie).set_opacity(MAP_OPACITY)
 
     video = CompositeVideoClip([cam_clip,
                                 map_clip.set_pos(("right","top"))])
 
-    if "fps" not in profile:
-        profile["fps"] = cam_clip.fps
+    for target_name, profile in targets:
+        if "fps" not in profile:
+            profile["fps"] = cam_clip.fps
     
-    video.write_videofile(target_name, **profile)
+        video.write_videofile(target_name, **profile)
+
+def renderOverlay(filename, maps_movie, targets, start=None, length=None):
+    """Render the video with map overlay for a list of
+    (target_name, profile) tuples. start and length in seconds select a
+    part of the video, the maps movie has to begin at start."""
+    backend = config.get("Video", "overlay_backend")
+    if backend == "ffmpeg":
+        try:
+            renderOverlayFfmpeg(filename, maps_movie, targets, start, length)
+        except Exception as e:
+            logging.getLogger(__name__).warning("%s, falling back to moviepy" % e)
+            for target_name, _ in targets:
+                if os.access(target_name, os.F_OK):
+                    os.remove(target_name)
+            renderOverlayMoviepy(filename, maps_movie, targets, start, length)
+    elif backend == "moviepy":
+        renderOverlayMoviepy(filename, maps_movie, targets, start, length)
+    else:
+        raise Exception("Unknown overlay backend '%s'" % backend)
     
-    logging.getLogger(__name__).info("Movie rendered into %s" % target_name)
+    for target_name, _ in targets:
+        logging.getLogger(__name__).info("Movie rendered into %s" % target_name)
+
+def chunk_plan(keyframes, duration, chunk_duration):
+    """Split the video at keyframes into [start, length] chunks of at
+    least chunk_duration seconds. Lists, so the plan compares equal to
+    the one read back from a checkpoint."""
+    bounds = [0.0]
+    for ts, _ in keyframes:
+        if ts - bounds[-1] >= chunk_duration and duration - ts >= chunk_duration / 2:
+            bounds.append(ts)
+    return [[t0, t1 - t0] for t0, t1 in zip(bounds, bounds[1:] + [duration])]
+
+def chunk_targets(targets, parts_dir, num):
+    """Targets for a single chunk inside parts_dir"""
+    result = []
+    for idx, (target_name, profile) in enumerate(targets):
+        _, ext = os.path.splitext(target_name)
+        profile = dict(profile)
+        if "temp_audiofile" in profile:
+            # chunks might be rendered in parallel
+            _, audio_ext = os.path.splitext(profile["temp_audiofile"])
+            profile["temp_audiofile"] = tempfile.mktemp(suffix=audio_ext)
+        result.append((os.path.join(parts_dir, "%04d_%d%s" % (num, idx, ext)), profile))
+    return result
+
+def renderChunk(filename, track_points, track, start_time, chunk, targets):
+    """Render maps and overlay of a single chunk"""
+    start, length = chunk
+    for target_name, _ in targets:
+        if os.access(target_name, os.F_OK):
+            os.remove(target_name) # leftover of an interrupted run
+    maps_movie = cachedMaps(filename, track_points, track, start_time + start, length)
+    renderOverlay(filename, maps_movie, targets, start, length)
+    if not map_cache().enabled:
+        os.remove(maps_movie)
+
+def concat_chunks(parts, target_name, profile):
+    """Join the rendered chunks into target_name without re-encoding"""
+    list_name = target_name + ".concat"
+    with open(list_name, "w") as f:
+        for part in parts:
+            f.write("file '%s'\n" % os.path.abspath(part).replace("'", "'\\''"))
+    params = profile.get("ffmpeg_params", [])
+    movflags = params[params.index("-movflags"):params.index("-movflags") + 2] if "-movflags" in params else []
+    rc = subprocess.call([ffmpeg.get_exe(), "-hide_banner", "-loglevel", "error", "-n",
+                          "-f", "concat", "-safe", "0", "-i", list_name,
+                          "-map", "0", "-c", "copy"] + movflags + [target_name])
+    os.remove(list_name)
+    if rc != 0:
+        raise Exception("Failed to concat chunks into %s" % target_name)
+
+def renderChunked(filename, track_points, track, start_time, duration, targets):
+    """Render the video in keyframe aligned chunks. Finished chunks are
+    recorded in a checkpoint file, so an interrupted job continues with
+    the missing chunks. Chunks are rendered by video_chunk_jobs
+    processes in parallel."""
+    chunk_duration = config.getfloat("Video", "chunk_duration")
+    plan = chunk_plan(fetch_keyframes(filename), duration, chunk_duration)
+
+    parts_dir = targets[0][0] + ".parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    checkpoint_name = os.path.join(parts_dir, "checkpoint.json")
+    job = {"filename": filename,
+           "plan": plan,
+           "targets": [t for t, _ in targets],
+           "done": []}
+    try:
+        with open(checkpoint_name) as f:
+            checkpoint = json.load(f)
+        if all(checkpoint.get(key) == job[key] for key in ("filename", "plan", "targets")):
+            job["done"] = checkpoint["done"]
+            logging.getLogger(__name__).info("Resuming, %d of %d chunks done" % (len(job["done"]), len(plan)))
+    except (OSError, ValueError):
+        pass
+
+    def save_checkpoint():
+        with open(checkpoint_name + ".tmp", "w") as f:
+            json.dump(job, f)
+        os.replace(checkpoint_name + ".tmp", checkpoint_name)
+
+    save_checkpoint()
+    missing = [num for num in range(len(plan)) if num not in job["done"]]
+    with ProcessPoolExecutor(max_workers=config.getint("Video", "chunk_jobs")) as executor:
+        futures = { executor.submit(renderChunk, filename, track_points, track, start_time,
+                                    plan[num], chunk_targets(targets, parts_dir, num)) : num
+                    for num in missing }
+        for future in as_completed(futures):
+            future.result()
+            job["done"].append(futures[future])
+            save_checkpoint()
+            logging.getLogger(__name__).info("Chunk %d of %d done" % (len(job["done"]), len(plan)))
+
+    for idx, (target_name, profile) in enumerate(targets):
+        parts = [name for name, _ in
+                 (chunk_targets(targets, parts_dir, num)[idx] for num in range(len(plan)))]
+        concat_chunks(parts, target_name, profile)
+        logging.getLogger(__name__).info("Movie rendered into %s" % target_name)
+
+    shutil.rmtree(parts_dir)
 
 def location_name(db, track, timestamp):
     feature = db.get_nearest_feature(track.get(timestamp), features=["S", "P"])
     return feature.name
 
-def make_target(db, filename, video_id, start_time, duration, track):
-    profile = config.get("Video", "movie_profile")
-    profile_section = config["Movie_Profile_" + profile]
+def make_target(db, filename, video_id, start_time, duration, track, profile):
+    """Target name of the movie of a profile, None if it exists already"""
+    profile_section = config[MOVIE_PROFILE_PREFIX + profile]
     ext = profile_section.get("ext")
     timestamp = format_datetime(start_time,
                                 config.get("Video", "video_timestamp_format"),
@@ -170,12 +482,35 @@ def make_target(db, filename, video_id, start_time, duration, track):
         "ext": ext}
     
     if os.access(target_name, os.R_OK):
-        raise Exception("Target '%s' already exists, skipping" % target_name)
-    else:
-        logging.getLogger(__name__).info("Target name: %s", target_name)
+        logging.getLogger(__name__).warning("Target '%s' already exists, skipping" % target_name)
+        return None
+    logging.getLogger(__name__).info("Target name: %s", target_name)
     return target_name
 
-def build_profile():
+def movie_profiles():
+    """Names of the profiles listed in video_movie_profile"""
+    profiles = [p.strip() for p in config.get("Video", "movie_profile").split(",") if p.strip()]
+    for profile in profiles:
+        if not config.has_section(MOVIE_PROFILE_PREFIX + profile):
+            raise Exception("Unknown movie profile '%s'" % profile)
+    return profiles
+
+def make_targets(db, filename, video_id, start_time, duration, track):
+    """List of (target_name, profile) for all profiles whose target does
+    not exist yet"""
+    targets = []
+    for profile_name in movie_profiles():
+        target_name = make_target(db, filename, video_id, start_time, duration, track, profile_name)
+        if target_name is None:
+            continue
+        if target_name in [t for t, _ in targets]:
+            raise Exception("Profiles render into the same target '%s', add %%(profile)s to video_target" % target_name)
+        targets.append((target_name, build_profile(profile_name)))
+    if not targets:
+        raise Exception("All targets exist already, skipping")
+    return targets
+
+def build_profile(profile_name):
 
     def boolean(value):
         return value.lower() in ["true","yes"]
@@ -190,7 +525,7 @@ def build_profile():
     def tempname(suffix):
         return tempfile.mktemp(suffix=suffix)
     
-    section = config[MOVIE_PROFILE_PREFIX + config.get("Video", "movie_profile")]
+    section = config[MOVIE_PROFILE_PREFIX + profile_name]
     profile = dict()
 
     known_args = { "fps" : int,
@@ -226,8 +561,6 @@ if __name__ == "__main__":
         try:
             logging.getLogger(__name__).info("Processing video %s" % filename)
         
-            profile = build_profile()
-
             with DB() as db:
                 video_info = db.get_video(filename)
                 if video_info is None:
@@ -242,13 +575,17 @@ if __name__ == "__main__":
                     track_points = db.fetch_trackpoints(start_time, start_time + duration)
                 track = Track(track_points)
 
-                target_name = make_target(db, filename, video_id, start_time, duration, track)
+                targets = make_targets(db, filename, video_id, start_time, duration, track)
                 
-                maps_movie = makeMaps(filename, track, start_time, duration)
+                if config.getfloat("Video", "chunk_duration") > 0:
+                    renderChunked(filename, track_points, track, start_time, duration, targets)
+                else:
+                    maps_movie = cachedMaps(filename, track_points, track, start_time, duration)
 
-                renderOverlay(filename, maps_movie, target_name, profile)
+                    renderOverlay(filename, maps_movie, targets)
 
-                os.remove(maps_movie)
+                    if not map_cache().enabled:
+                        os.remove(maps_movie)
                 
         except Exception as e:
             logging.getLogger(__name__).error(e)
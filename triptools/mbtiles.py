@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+
+import redis
+
+from triptools import config
+from triptools import osm_mapper
+from triptools.tile_support import MBTilesStore, RedisTileStore
+
+logging.basicConfig(level=logging.INFO)
+
+def transfer(store, name, importing, min_zoom, max_zoom):
+    if os.path.isdir(name) or (not importing and not name.endswith(".mbtiles")):
+        if importing:
+            return store.import_dir(name, min_zoom, max_zoom)
+        return store.export_dir(name, min_zoom, max_zoom)
+    if importing:
+        return store.import_mbtiles(name, min_zoom, max_zoom)
+    return store.export_mbtiles(name, min_zoom, max_zoom)
+
+if __name__ == "__main__":
+
+    try:
+        mbtiles_file = config.get("Map", "mbtiles_file")
+        if not mbtiles_file:
+            raise Exception("map_mbtiles_file not configured")
+        store = MBTilesStore(mbtiles_file, osm_mapper.parser)
+        min_zoom = config.getint("MBTiles", "min_zoom")
+        max_zoom = config.getint("MBTiles", "max_zoom")
+
+        if config.getboolean("MBTiles", "redis_import"):
+            count = store.import_redis(RedisTileStore(redis.Redis(config.get("Map", "redis_host")), None))
+            logging.getLogger(__name__).info("%d tiles copied from redis into %s", count, mbtiles_file)
+
+        import_name = config.get("MBTiles", "import")
+        if import_name:
+            count = transfer(store, import_name, True, min_zoom, max_zoom)
+            logging.getLogger(__name__).info("%d tiles imported from %s", count, import_name)
+
+        export_name = config.get("MBTiles", "export")
+        if export_name:
+            count = transfer(store, export_name, False, min_zoom, max_zoom)
+            logging.getLogger(__name__).info("%d tiles exported to %s", count, export_name)
+
+    except Exception as e:
+        logging.getLogger(__name__).error(e, exc_info=True)
+        sys.exit(1)
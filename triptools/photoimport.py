@@ -30,6 +30,7 @@ def get_thumbnail(filename):
 if __name__ == "__main__":
 
     with DB() as db:
+        added = 0
         for filename in get_names(config.get("Photo", "name"), config.get("Photo", "mask")):
             try:
                 logging.getLogger(__name__).info("Processing %s" % filename)
@@ -42,6 +43,11 @@ if __name__ == "__main__":
                 if location:
                     if db.add_photo(location) == 1:
                         logging.getLogger(__name__).info("Photo %s added." % filename)
+                        added += 1
 
             except Exception as e:
                 logging.getLogger(__name__).error(e)
+
+        if added:
+            # invalidate maps cached by photoserve
+            db.bump_data_version("photos")
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import cairocffi as cairo
-from functools import lru_cache
+from io import BytesIO
+import json
 import logging
 import math
 import mimetypes
@@ -10,14 +11,19 @@ import os
 import re
 import sys
 
-from flask import Flask, request, Response, redirect, render_template, make_response, send_file
+from PIL import Image
+from flask import Flask, request, Response, abort, jsonify, redirect, render_template
 from werkzeug.routing import FloatConverter as BaseFloatConverter
-from gevent.wsgi import WSGIServer
 
 from triptools import config
 from triptools import DB
 from triptools import osm_mapper
+from triptools.cache_support import DataVersion, make_key
 from triptools.common import Trackpoint, format_datetime
+from triptools.preview_support import PreviewCache, make_sprite, sprite_offset
+from triptools.serve_support import heavy, serve
+from triptools.web_support import (conditional_response, file_response, get_rendered_tile, map_etag, map_key,
+                                   render_cache, tile_key)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -39,17 +45,13 @@ SIZE = None
 name_mask = None
 db = None
 videos = None
+# bumped by photoimport, part of all map ETags and cache keys
+photos_version = None
+previews = None
+cache = None
 
 app = setup_app()
 
-#@app.after_request
-def add_header(r):
-    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    r.headers['Cache-Control'] = 'public, max-age=0'
-    return r
-
 def round_xy(lon, lat):
     def round_float(x):
         return int(x * 10000) / 10000
@@ -61,39 +63,125 @@ def part(lon, lat, zoom):
 def map_center(map_tile):
     return round_xy(*map_tile.geocode((int(SIZE[0]/2), int(SIZE[1]/2))))
 
-@lru_cache(maxsize=1024)
+def map_for(lon, lat, zoom):
+    """Map of a page without rendering it"""
+    return osm_mapper.centered_map(lon, lat, zoom, SIZE)
+
 def add_info(photo):
     photoconf = config["Photo"]
     photo.add("name", db.get_nearest_feature(photo).name)
     photo.add("ts_str", format_datetime(photo.timestamp, photoconf["comment_timestamp_format"], photoconf["img_timezone"]))
+    photo.add("thumbnail_etag", make_key(photo.thumbnail))
+    if photo.thumbnail:
+        size = Image.open(BytesIO(photo.thumbnail)).size
+        photo.add("thumbnail_size", tuple(min(a, b) for a, b in zip(size, thumbnail_cell())))
+
+# max number of thumbnails in one sprite sheet
+MAX_SPRITE = 200
+
+def thumbnail_cell():
+    return config.getint("Photo", "thumbwidth"), config.getint("Photo", "thumbheight")
+
+def sprite_etag(ids):
+    return make_key("sprite", photos_version.get(), thumbnail_cell(), ids)
+
+def sprite_info(photos):
+    """URL of the sprite sheet with the thumbnails of photos and the
+    offset of each thumbnail in it by photo id"""
+    ids = sorted(p.id for p in photos if p.thumbnail)[:MAX_SPRITE]
+    url = "/sprite.png?ids=%s&v=%s" % (",".join(str(id) for id in ids), sprite_etag(ids))
+    return url, {id: sprite_offset(idx, thumbnail_cell()) for idx, id in enumerate(ids)}
+
+def get_sprite(ids):
+
+    @heavy
+    def render():
+        thumbnails = db.get_thumbnails(ids)
+        return make_sprite([thumbnails.get(id) for id in ids], thumbnail_cell())
+
+    return cache.cached(sprite_etag(list(ids)), render)
 
-@lru_cache(maxsize=1024)
 def get_photos(lon, lat, map_tile):
+    """Photos on the map, closest to lon/lat first"""
     lon1, lat1, lon2, lat2 = map_tile.extent
-    photos = db.get_photos_bb(lon, lat, lon1, lat1, lon2, lat2, limit=100)
-    for photo in photos:
-        add_info(photo)
-    return photos
 
-@lru_cache(maxsize=1024)
-def get_rendered_png(lon, lat, zoom):
-    map_tile, image = osm_mapper.get_centered_map(lon, lat, zoom, SIZE)
-    surface = osm_mapper.as_surface(image)
-    photos = get_photos(*map_center(map_tile), map_tile)
+    def query():
+        photos = db.get_photos_bb(lon, lat, lon1, lat1, lon2, lat2, limit=100)
+        for photo in photos:
+            add_info(photo)
+        # the list shows thumbnails from the sprite sheet, so only
+        # whether a photo has one is kept
+        return json.dumps([dict(photo.additional_info,
+                                timestamp=photo.timestamp, lon=photo.longitude, lat=photo.latitude,
+                                alt=photo.altitude, thumbnail=photo.thumbnail is not None)
+                           for photo in photos]).encode("utf8")
+
+    # JSON, the cache may be shared with other hosts
+    key = map_etag(photos_version.get(), "photos", *["%.4f" % v for v in (lon, lat, lon1, lat1, lon2, lat2)])
+    return [Trackpoint(info.pop("timestamp"), info.pop("lon"), info.pop("lat"), info.pop("alt"), **info)
+            for info in json.loads(cache.cached(key, query).decode("utf8"))]
+
+# photo markers reach at most this far in pixels around their position
+MARKER_RADIUS = 16
+
+def marker_radius(count):
+    return min(4 + 3 * math.log2(count), MARKER_RADIUS - 2)
+
+def draw_clusters(map_tile, surface, clusters):
+    """Single photos as dots, clusters as circles labelled with their count"""
     cr = cairo.Context(surface)
     cr.set_line_width(5)
-    for p in photos:
-        x, y = map_tile.rev_geocode( (p.longitude, p.latitude) )
-        cr.move_to(x, y)
-        cr.arc(x, y, 2, 0, 2 * math.pi)
+    for p in clusters:
+        if p.count == 1:
+            x, y = map_tile.rev_geocode( (p.longitude, p.latitude) )
+            cr.move_to(x, y)
+            cr.arc(x, y, 2, 0, 2 * math.pi)
     cr.stroke()
-    data = surface.write_to_png()
-    return map_tile, data
+
+    cr.set_line_width(2)
+    cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+    cr.set_font_size(10)
+    for p in clusters:
+        if p.count > 1:
+            x, y = map_tile.rev_geocode( (p.longitude, p.latitude) )
+            r = marker_radius(p.count)
+            cr.new_path()
+            cr.arc(x, y, r, 0, 2 * math.pi)
+            cr.set_source_rgba(1, 1, 1, 0.8)
+            cr.fill_preserve()
+            cr.set_source_rgb(0, 0, 0)
+            cr.stroke()
+            text = str(p.count)
+            extents = cr.text_extents(text)
+            cr.move_to(x - extents[2] / 2 - extents[0], y - extents[3] / 2 - extents[1])
+            cr.show_text(text)
+
+def get_clusters(map_tile):
+    """Photo clusters of the map including markers just outside of it
+    which overlap its border"""
+    w, h = map_tile.size
+    lon1, lat1 = map_tile.geocode((-MARKER_RADIUS, h + MARKER_RADIUS))
+    lon2, lat2 = map_tile.geocode((w + MARKER_RADIUS, -MARKER_RADIUS))
+    return db.get_photo_clusters(lon1, lat1, lon2, lat2, map_tile.zoom,
+                                 config.getint("Webserver", "cluster_size"))
+
+def get_rendered_png(lon, lat, zoom):
+
+    @heavy
+    def render():
+        map_tile, surface = osm_mapper.get_centered_map(lon, lat, zoom, SIZE)
+        draw_clusters(map_tile, surface, get_clusters(map_tile))
+        return surface.write_to_png()
+
+    return cache.cached(map_key(photos_version.get(), SIZE, lon, lat, zoom), render)
+
+def draw_tile(map_tile, surface):
+    draw_clusters(map_tile, surface, get_clusters(map_tile))
 
 @app.route('/', defaults={"lon" : 7.0, "lat" : 50, "zoom" : 7})
 @app.route('/<float:lon>/<float:lat>/<int:zoom>')
 def root(lon, lat, zoom):
-    map_tile, _ = get_rendered_png(lon, lat, zoom)
+    map_tile = map_for(lon, lat, zoom)
     lon1, lat1, lon2, lat2 = map_tile.extent
     lon, lat = map_center(map_tile)
     photos = get_photos(lon, lat, map_tile)
@@ -109,13 +197,15 @@ def root(lon, lat, zoom):
                            right=part(lon + h_step, lat, zoom),
                            zoom_in=part(lon, lat, zoom + 1),
                            zoom_out=part(lon, lat, zoom -1),
+                           map_etag=map_key(photos_version.get(), SIZE, lon, lat, zoom),
+                           sprite=sprite_info(photos),
                            photos=photos)
 
 @app.route('/zoom/<float:lon>/<float:lat>/<int:zoom>', methods=["GET", "POST"])
 def zoom(lon, lat, zoom):
     x = int(request.form["img.x"])
     y = int(request.form["img.y"])
-    map_tile, data = get_rendered_png(lon, lat, zoom)
+    map_tile = map_for(lon, lat, zoom)
     lon, lat = map_tile.geocode((x,y))
     return redirect(part(lon, lat, zoom+1), code=302)
 
@@ -126,51 +216,105 @@ def view(id):
     return render_template("photo.jinja2",
                            id=id,
                            size=SIZE,
-                           name=photo.name)
+                           name=photo.name,
+                           preview_sizes=previews.sizes if previews.enabled else [])
+
+@app.route('/preview/<int:id>/<int:size>.jpg')
+def preview(id, size):
+    if size not in previews.sizes:
+        abort(404)
+    photo = db.get_photo(id)
+    if not previews.enabled:
+        return file_response(photo.filename, config.getint("Webserver", "file_max_age"))
+    name, key = heavy(previews.get)(photo.filename, size)
+    return file_response(name, config.getint("Webserver", "file_max_age"), etag=key, mimetype="image/jpeg")
 
 @app.route('/v/<key>')
 def v(key):
     photo = db.get_photo_by_hash(key)
     add_info(photo)
-    return send_file(photo.filename)
+    # addressed by the hash of the photo
+    return file_response(photo.filename, config.getint("Webserver", "file_max_age"), etag=key, immutable=True)
 
 @app.route('/sendimg/<int:id>')
 def sendimg(id):
     photo = db.get_photo(id)
-    return send_file(photo.filename)
+    return file_response(photo.filename, config.getint("Webserver", "file_max_age"))
 
 @app.route('/sendthumb/<int:id>')
 def sendthumb(id):
     photo = db.get_photo(id)
-    return make_response(photo.thumbnail, 200, { "content-type" : "image/png" })
+    return conditional_response(make_key(photo.thumbnail), lambda: photo.thumbnail, "image/png")
+
+@app.route('/sprite.png')
+def sprite():
+    try:
+        ids = tuple(sorted(int(id) for id in request.args["ids"].split(",") if id))
+    except (KeyError, ValueError):
+        abort(400)
+    if len(ids) > MAX_SPRITE:
+        abort(400)
+    return conditional_response(sprite_etag(list(ids)), lambda: get_sprite(ids), "image/png")
 
 @app.route('/update/<float:lon>/<float:lat>/<int:zoom>')
 def update(lon, lat, zoom):
-    map_tile, data = get_rendered_png(lon, lat, zoom)
+    map_tile = map_for(lon, lat, zoom)
     lon, lat = map_tile.geocode((int(request.args["x"]), int(request.args["y"])))
     photos = get_photos(lon, lat, map_tile)
     return render_template("photo_list.jinja2",
                            enumerate=enumerate,
+                           sprite=sprite_info(photos),
                            photos=photos)
 
 @app.route("/<float:lon>/<float:lat>/<int:zoom>/map.png")
 def map(lon, lat, zoom):
-    map_tile, data = get_rendered_png(lon, lat, zoom)
-    return make_response(data, 200, { "content-type" : "image/png" })
+    return conditional_response(map_key(photos_version.get(), SIZE, lon, lat, zoom),
+                                lambda: get_rendered_png(lon, lat, zoom),
+                                "image/png")
+
+@app.route("/tiles/<int:zoom>/<int:x>/<int:y>.png")
+def tile(zoom, x, y):
+    if not osm_mapper.valid_tile(zoom, x, y):
+        abort(404)
+    return conditional_response(tile_key(photos_version.get(), zoom, x, y),
+                                lambda: get_rendered_tile(cache, photos_version.get(), zoom, x, y, draw_tile),
+                                "image/png",
+                                config.getint("Webserver", "tile_max_age"))
+
+@app.route("/clusters/<int:zoom>/<int:x>/<int:y>.json")
+def clusters(zoom, x, y):
+    if not osm_mapper.valid_tile(zoom, x, y):
+        abort(404)
+    map_tile = osm_mapper.tile_map(zoom, x, y)
+    w, h = map_tile.size
+
+    def on_tile(cluster):
+        # each cluster is listed by the one tile containing its center
+        x, y = map_tile.rev_geocode((cluster.longitude, cluster.latitude))
+        return 0 <= x < w and 0 <= y < h
+
+    return jsonify([{"count": c.count, "ids": c.ids, "lon": c.longitude, "lat": c.latitude}
+                    for c in get_clusters(map_tile) if on_tile(c)])
+
+@app.route("/stats")
+def stats():
+    return jsonify(render=cache.stats(), **osm_mapper.stats())
 
 if __name__ == "__main__":
 
     try:
         SIZE = (config.getint("Webserver", "map_width"),
                 config.getint("Webserver", "map_height"))
+        previews = PreviewCache(config.get("Photo", "preview_cache_dir"),
+                                config.getfloat("Photo", "preview_cache_mb"),
+                                [int(s) for s in config.get("Photo", "preview_sizes").split(",") if s.strip()],
+                                config.getint("Photo", "preview_quality"))
+        cache = render_cache()
 
         with DB() as db:
-            #            http_server = WSGIServer((config.get("Webserver", "interface"), config.getint("Webserver", "port")), app)
-            #            http_server.serve_forever()
+            photos_version = DataVersion(db, "photos", config.getint("Webserver", "data_version_check"))
+            serve(app)
 
-            app.run(host=config.get("Webserver", "interface"),
-                    port=config.getint("Webserver", "port"))
-            
     except Exception as e:
         logging.getLogger(__name__).error(e)
         sys.exit(1)
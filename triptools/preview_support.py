@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+import logging
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+from triptools.cache_support import FileCache, make_key
+
+logging.basicConfig(level=logging.INFO)
+
+
+class PreviewCache:
+    """Downscaled JPEG previews of photos, rendered on first request and
+    kept in a FileCache. An empty directory disables previews."""
+
+    def __init__(self, directory, max_mb, sizes, quality):
+        self.cache = FileCache(directory, max_mb, suffix=".jpg")
+        self.sizes = sorted(sizes)
+        self.quality = quality
+
+    @property
+    def enabled(self):
+        return self.cache.enabled
+
+    def key(self, filename, size):
+        """Changes whenever the original is modified"""
+        stat = os.stat(filename)
+        return make_key(filename, stat.st_mtime, stat.st_size, size, self.quality)
+
+    def render(self, filename, size, target):
+        im = Image.open(filename)
+        # let the JPEG decoder scale down, so large originals are not
+        # decoded at full resolution
+        im.draft("RGB", (size, size))
+        im = ImageOps.exif_transpose(im)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        im.thumbnail((size, size), Image.LANCZOS)
+        im.save(target, "JPEG", quality=self.quality, optimize=True, progressive=True)
+
+    def get(self, filename, size):
+        """Name of the preview of filename fitting into size x size and its key"""
+        key = self.key(filename, size)
+        name = self.cache.get(key)
+        if name is None:
+            # .tmp files are ignored by eviction
+            fd, tmp_name = tempfile.mkstemp(suffix=".tmp", dir=self.cache.directory)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    self.render(filename, size, f)
+                name = self.cache.put(key, tmp_name)
+            except Exception:
+                os.remove(tmp_name)
+                raise
+            logging.getLogger(__name__).info("Rendered %dpx preview of %s" % (size, filename))
+        return name, key
+
+
+# thumbnails per row of a sprite sheet
+SPRITE_COLUMNS = 10
+
+def sprite_offset(index, cell_size):
+    """Position of the index-th thumbnail in a sprite sheet"""
+    w, h = cell_size
+    return (index % SPRITE_COLUMNS) * w, (index // SPRITE_COLUMNS) * h
+
+def make_sprite(thumbnails, cell_size):
+    """PNG with all thumbnails (PNG data or None) in a grid of cells of
+    cell_size, each one in the top left corner of its cell"""
+    w, h = cell_size
+    rows = (len(thumbnails) + SPRITE_COLUMNS - 1) // SPRITE_COLUMNS
+    sheet = Image.new("RGBA", (min(len(thumbnails), SPRITE_COLUMNS) * w, rows * h))
+    for idx, data in enumerate(thumbnails):
+        if data:
+            im = Image.open(BytesIO(data))
+            if im.size[0] > w or im.size[1] > h:
+                im = im.crop((0, 0, min(im.size[0], w), min(im.size[1], h)))
+            sheet.paste(im, sprite_offset(idx, cell_size))
+    buffer = BytesIO()
+    sheet.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""HTTP range responses for large files. Files stay open between
+requests and are read with pread or sent with os.sendfile by the server,
+so the file position is never shared."""
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import threading
+import uuid
+
+from flask import Response
+
+logging.basicConfig(level=logging.INFO)
+
+# more ranges in one request are treated as an abuse
+MAX_RANGES = 16
+
+def parse_ranges(header, size):
+    """Sorted, merged (start, end) byte ranges with inclusive ends of a
+    Range header for a file of size bytes. None if the header is not a
+    valid bytes range and should be ignored, an empty list if no range is
+    satisfiable."""
+    m = re.fullmatch(r"\s*bytes\s*=\s*(.+)", header or "")
+    if not m:
+        return None
+    specs = [spec.strip() for spec in m.group(1).split(",") if spec.strip()]
+    if not specs:
+        # e.g. "bytes=,", syntactically invalid
+        return None
+    ranges = []
+    for spec in specs:
+        m = re.fullmatch(r"(\d*)\s*-\s*(\d*)", spec)
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        if not m.group(1):
+            # suffix range, the last n bytes
+            n = int(m.group(2))
+            if n > 0 and size > 0:
+                ranges.append((max(size - n, 0), size - 1))
+            continue
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+        if m.group(2) and end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class OpenFile:
+    """File descriptor shared by all responses of one file"""
+
+    def __init__(self, filename):
+        self.fd = os.open(filename, os.O_RDONLY)
+        stat = os.fstat(self.fd)
+        self.version = (stat.st_mtime, stat.st_size)
+        self.size = stat.st_size
+        self.users = 0
+        self.evicted = False
+
+
+class FileHandles:
+    """Open files by name, at most max_open of them unless still in use.
+    A file is reopened if it changed."""
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def acquire(self, filename):
+        stat = os.stat(filename)
+        with self.lock:
+            f = self.files.pop(filename, None)
+            if f is not None and f.version != (stat.st_mtime, stat.st_size):
+                self.evict(f)
+                f = None
+            if f is None:
+                f = OpenFile(filename)
+                self.opened += 1
+            else:
+                self.reused += 1
+            self.files[filename] = f
+            f.users += 1
+            while len(self.files) > self.max_open:
+                self.evict(self.files.popitem(last=False)[1])
+            return f
+
+    def release(self, f):
+        with self.lock:
+            f.users -= 1
+            if f.evicted and f.users == 0:
+                os.close(f.fd)
+
+    def evict(self, f):
+        f.evicted = True
+        if f.users == 0:
+            os.close(f.fd)
+
+    def stats(self):
+        with self.lock:
+            return {"open": len(self.files), "opened": self.opened, "reused": self.reused}
+
+
+class RangeBody:
+    """WSGI response body of byte ranges of a file, each range preceded
+    by its header bytes. Servers knowing this class send the ranges with
+    os.sendfile, others iterate over chunks read with pread. The file is
+    only taken from the handles once the body is sent."""
+
+    def __init__(self, handles, filename, parts, trailer, chunk_size):
+        self.handles = handles
+        self.filename = filename
+        # (header, start, length)
+        self.parts = parts
+        self.trailer = trailer
+        self.chunk_size = chunk_size
+        self.file = None
+
+    def open(self):
+        """File descriptor to read from"""
+        if self.file is None:
+            self.file = self.handles.acquire(self.filename)
+        return self.file.fd
+
+    def __len__(self):
+        return sum(len(header) + length for header, _, length in self.parts) + len(self.trailer)
+
+    def __iter__(self):
+        fd = self.open()
+        for header, start, length in self.parts:
+            if header:
+                yield header
+            end = start + length
+            while start < end:
+                data = os.pread(fd, min(self.chunk_size, end - start), start)
+                if not data:
+                    raise Exception("%d bytes missing at the end of %s" % (end - start, self.filename))
+                start += len(data)
+                yield data
+        if self.trailer:
+            yield self.trailer
+
+    def close(self):
+        if self.file is not None:
+            self.handles.release(self.file)
+            self.file = None
+
+
+def range_response(handles, filename, ranges, mimetype, chunk_size):
+    """206 response with ranges of filename as parsed by parse_ranges, 416
+    if none of them is satisfiable"""
+    size = os.path.getsize(filename)
+    if not ranges:
+        rv = Response(status=416)
+        rv.headers["Content-Range"] = "bytes */%d" % size
+        return rv
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        body = RangeBody(handles, filename, [(b"", start, end - start + 1)], b"", chunk_size)
+        rv = Response(body, 206, mimetype=mimetype, direct_passthrough=True)
+        rv.headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [(("\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" %
+                   (boundary, mimetype, start, end, size)).encode("latin-1"),
+                  start, end - start + 1)
+                 for start, end in ranges]
+        body = RangeBody(handles, filename, parts, ("\r\n--%s--\r\n" % boundary).encode("latin-1"), chunk_size)
+        rv = Response(body, 206, direct_passthrough=True)
+        rv.headers["Content-Type"] = "multipart/byteranges; boundary=%s" % boundary
+    rv.headers["Content-Length"] = str(len(body))
+    return rv
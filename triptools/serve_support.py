@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Serving the web apps with gevent. The servers run under
+python -m gevent.monkey, which patches the standard library before
+triptools creates its locks and threads, so waiting for the DB, redis
+or tile downloads lets other requests run."""
+
+from functools import wraps
+import logging
+import os
+
+from gevent import monkey
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIHandler, WSGIServer
+from gevent.socket import wait_read, wait_write
+import psycopg2
+from psycopg2 import extensions
+
+from triptools import config
+from triptools.range_support import RangeBody
+
+logging.basicConfig(level=logging.INFO)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """Let psycopg2 wait for the DB in the gevent hub"""
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+extensions.set_wait_callback(gevent_wait_callback)
+
+# renders running at the same time, set by serve()
+render_slots = BoundedSemaphore(1)
+
+def heavy(view):
+    """Limit the number of requests of a view running at the same time.
+    Renders are CPU bound, so more of them only delay the cheap requests."""
+
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        with render_slots:
+            return view(*args, **kwargs)
+
+    return wrapped
+
+class SendfileHandler(WSGIHandler):
+    """Sends the file ranges of a RangeBody with os.sendfile, so their
+    data never passes through Python"""
+
+    def process_result(self):
+        if not isinstance(self.result, RangeBody) or self.environ.get("wsgi.url_scheme") != "http":
+            return super().process_result()
+
+        fd = self.result.open()
+        sock = self.socket.fileno()
+        # headers
+        self.write(b"")
+        for header, start, length in self.result.parts:
+            self._sendall(header)
+            while length > 0:
+                try:
+                    sent = os.sendfile(sock, fd, start, length)
+                except BlockingIOError:
+                    wait_write(sock)
+                    continue
+                if sent == 0:
+                    raise Exception("%d bytes missing at the end of %s" % (length, self.result.filename))
+                start += sent
+                length -= sent
+                self.response_length += sent
+        self._sendall(self.result.trailer)
+
+def serve(app):
+    """Serve app until interrupted, each request on a greenlet of a pool"""
+    global render_slots
+    if not monkey.is_module_patched("threading"):
+        # locks created unpatched block the whole server
+        raise Exception("Run the server with python -m gevent.monkey --module")
+    web_conf = config["Webserver"]
+    render_slots = BoundedSemaphore(web_conf.getint("render_workers"))
+    # each request holds at most one DB connection, so the pool must not
+    # be larger than the DB connection pool
+    workers = Pool(web_conf.getint("workers"))
+    http_server = WSGIServer((web_conf["interface"], web_conf.getint("port")), app,
+                             spawn=workers, handler_class=SendfileHandler)
+    logging.getLogger(__name__).info("Serving on %s:%s with %d workers" %
+                                     (web_conf["interface"], web_conf["port"], workers.size))
+    http_server.serve_forever()
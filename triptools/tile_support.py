@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+import logging
+import os
+import re
+import sqlite3
+import string
+import threading
+
+import aiohttp
+import asyncio
+import cairocffi as cairo
+from geotiler.map import Tile
+from geotiler.tile.io import PARAMS, fetch_tile, fetch_tiles
+import numpy as np
+import PIL.Image
+
+logging.basicConfig(level=logging.INFO)
+
+
+class TileCache:
+    """In-process LRU of decoded map tiles as Cairo surfaces, bounded by
+    memory"""
+
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tile_size(surface):
+        return surface.get_stride() * surface.get_height()
+
+    def get(self, url):
+        with self.lock:
+            image = self.tiles.get(url)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.tiles.move_to_end(url)
+            return image
+
+    def put(self, url, image):
+        size = TileCache.tile_size(image)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.tiles.pop(url, None)
+            if old is not None:
+                self.size -= TileCache.tile_size(old)
+            self.tiles[url] = image
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= TileCache.tile_size(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "tiles": len(self.tiles),
+                    "mb": round(self.size / 1024 / 1024, 1)}
+
+
+class TileUrlParser:
+    """Extract zoom and tile coordinates from tile URLs of a provider"""
+
+    def __init__(self, provider):
+        expr = ""
+        for literal, field, _, _ in string.Formatter().parse(provider.url):
+            expr += re.escape(literal)
+            if field in ("z", "x", "y"):
+                expr += r"(?P<%s>\d+)" % field
+            elif field is not None:
+                expr += ".*?"
+        self.expr = re.compile(expr + "$")
+
+    def coord(self, url):
+        """(zoom, x, y) of url or None"""
+        m = self.expr.match(url)
+        if m is None:
+            return None
+        return int(m.group("z")), int(m.group("x")), int(m.group("y"))
+
+    def key(self, url):
+        """Key identifying a tile independent of the tile server used"""
+        return self.coord(url) or url
+
+
+class RedisTileStore:
+    """Tile data in redis, keyed by tile URL"""
+
+    def __init__(self, client, timeout):
+        self.client = client
+        self.timeout = timeout
+
+    def get(self, url):
+        return self.client.get(url)
+
+    def set(self, url, data):
+        self.client.setex(url, self.timeout, data)
+
+    def has(self, url):
+        return bool(self.client.exists(url))
+
+    def urls(self):
+        for key in self.client.scan_iter(match="http*"):
+            yield key.decode("utf8")
+
+
+class MBTilesStore:
+    """Tile data in an MBTiles (SQLite) file. WAL mode allows concurrent
+    readers while tiles are added."""
+
+    def __init__(self, filename, parser):
+        self.filename = filename
+        self.parser = parser
+        self.local = threading.local()
+        with self.conn() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text PRIMARY KEY, value text)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            conn.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('name', ?)",
+                         (os.path.splitext(os.path.basename(filename))[0],))
+            conn.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')")
+
+    def conn(self):
+        """Connection of the current thread. SQLite connections must not
+        be used across fork, so a forked process connects again."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def tms_row(zoom, y):
+        """MBTiles counts rows from the south"""
+        return (1 << zoom) - 1 - y
+
+    def get_tile(self, zoom, x, y):
+        row = self.conn().execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                  (zoom, x, MBTilesStore.tms_row(zoom, y))).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set_tiles(self, tiles):
+        """Store (zoom, x, y, data) tuples in one transaction"""
+        with self.conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                             ((zoom, x, MBTilesStore.tms_row(zoom, y), data) for zoom, x, y, data in tiles))
+
+    def tiles(self, min_zoom=0, max_zoom=30):
+        """Iterate over all (zoom, x, y, data) tuples"""
+        c = self.conn().execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE zoom_level BETWEEN ? AND ?",
+                                (min_zoom, max_zoom))
+        for zoom, x, row, data in c:
+            yield zoom, x, MBTilesStore.tms_row(zoom, row), bytes(data)
+
+    def get(self, url):
+        coord = self.parser.coord(url)
+        return self.get_tile(*coord) if coord else None
+
+    def has(self, url):
+        coord = self.parser.coord(url)
+        if coord is None:
+            return False
+        zoom, x, y = coord
+        return self.conn().execute("SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                                   (zoom, x, MBTilesStore.tms_row(zoom, y))).fetchone() is not None
+
+    def set(self, url, data):
+        coord = self.parser.coord(url)
+        if coord:
+            self.set_tiles([coord + (data,)])
+
+    def import_mbtiles(self, filename, min_zoom=0, max_zoom=30):
+        other = MBTilesStore(filename, self.parser)
+        return self.import_tiles(other.tiles(min_zoom, max_zoom))
+
+    def export_mbtiles(self, filename, min_zoom=0, max_zoom=30):
+        other = MBTilesStore(filename, self.parser)
+        return other.import_tiles(self.tiles(min_zoom, max_zoom))
+
+    def import_dir(self, dirname, min_zoom=0, max_zoom=30):
+        """Import a z/x/y.png directory tree"""
+        def walk():
+            expr = re.compile(r"(\d+)/(\d+)/(\d+)\.\w+$")
+            for dirpath, dirnames, filenames in os.walk(dirname):
+                for filename in filenames:
+                    name = os.path.join(dirpath, filename)
+                    m = expr.search(name)
+                    if m and min_zoom <= int(m.group(1)) <= max_zoom:
+                        with open(name, "rb") as f:
+                            yield int(m.group(1)), int(m.group(2)), int(m.group(3)), f.read()
+        return self.import_tiles(walk())
+
+    def export_dir(self, dirname, min_zoom=0, max_zoom=30):
+        """Export into a z/x/y.png directory tree"""
+        count = 0
+        for zoom, x, y, data in self.tiles(min_zoom, max_zoom):
+            tile_dir = os.path.join(dirname, str(zoom), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(os.path.join(tile_dir, "%d.png" % y), "wb") as f:
+                f.write(data)
+            count += 1
+        return count
+
+    def import_redis(self, redis_store):
+        """Copy all tiles of a redis tile cache"""
+        def fetch():
+            for url in redis_store.urls():
+                coord = self.parser.coord(url)
+                data = redis_store.get(url)
+                if coord and data:
+                    yield coord + (data,)
+        return self.import_tiles(fetch())
+
+    def import_tiles(self, tiles, batch_size=1000):
+        """Store (zoom, x, y, data) tuples in batches, return count"""
+        count = 0
+        batch = []
+        for tile in tiles:
+            batch.append(tile)
+            if len(batch) >= batch_size:
+                self.set_tiles(batch)
+                count += len(batch)
+                batch = []
+        self.set_tiles(batch)
+        return count + len(batch)
+
+
+class TileFetcher:
+    """Tile downloader living on a single event loop. All requests share
+    one HTTP session and concurrent requests for the same tile share one
+    download. The session keeps at most limit_per_host connections to
+    each tile server, however many maps are fetched at the same time."""
+
+    def __init__(self, limit_per_host):
+        self.limit_per_host = limit_per_host
+        self.session = None
+        self.inflight = {}
+        self.downloads = 0
+        self.coalesced = 0
+
+    async def fetch(self, tile):
+        future = self.inflight.get(tile.url)
+        if future is not None:
+            self.coalesced += 1
+            result = await asyncio.shield(future)
+            return tile._replace(img=result.img, error=result.error)
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host), **PARAMS)
+        future = asyncio.get_event_loop().create_future()
+        self.inflight[tile.url] = future
+        try:
+            self.downloads += 1
+            result = await fetch_tile(self.session, tile)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.inflight[tile.url]
+
+    async def __call__(self, tiles, num_workers, **kw):
+        """geotiler downloader with at most num_workers requests in
+        flight for this call"""
+        semaphore = asyncio.Semaphore(num_workers)
+
+        async def bounded(tile):
+            async with semaphore:
+                return await self.fetch(tile)
+
+        for task in asyncio.as_completed([bounded(t) for t in tiles]):
+            tile = await task
+            if tile.error:
+                logging.getLogger(__name__).warning("Failed to download %s: %s" % (tile.url, tile.error))
+            yield tile
+
+    async def download(self, tiles, num_workers):
+        return [tile async for tile in self(tiles, num_workers)]
+
+    def stats(self):
+        return {"downloads": self.downloads,
+                "coalesced": self.coalesced,
+                "inflight": len(self.inflight)}
+
+
+def world_pixels(lons, lats, zoom, tile_size=256):
+    """Web Mercator pixel coordinates of lon/lat arrays at zoom, counted
+    from the top left corner of the world"""
+    scale = tile_size * 2.0 ** zoom
+    lats = np.radians(np.clip(np.asarray(lats, dtype=float), -85.051129, 85.051129))
+    x = (np.asarray(lons, dtype=float) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lats) + 1.0 / np.cos(lats)) / np.pi) / 2.0 * scale
+    return x, y
+
+def world_lonlat(x, y, zoom, tile_size=256):
+    """Inverse of world_pixels"""
+    scale = tile_size * 2.0 ** zoom
+    lons = np.asarray(x, dtype=float) / scale * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y, dtype=float) / scale))))
+    return lons, lats
+
+def corridor_tiles(lons, lats, zoom, corridor, tile_size=256):
+    """Set of (zoom, x, y) tiles within corridor pixels of a track. Gaps
+    between points are filled, so sparse tracks are covered too."""
+    if len(lons) == 0:
+        return set()
+    x, y = world_pixels(lons, lats, zoom, tile_size)
+    step = max(corridor, 1)
+    # insert points along segments longer than the corridor
+    steps = np.maximum(np.ceil(np.hypot(np.diff(x), np.diff(y)) / step), 1).astype(int)
+    # segment and fraction 1/n ... n/n of every inserted point
+    seg = np.repeat(np.arange(len(steps)), steps)
+    first = np.repeat(np.cumsum(steps) - steps, steps)
+    frac = (np.arange(len(seg)) - first + 1) / steps[seg]
+    x = np.concatenate([x[:1], x[seg] + (x[seg + 1] - x[seg]) * frac])
+    y = np.concatenate([y[:1], y[seg] + (y[seg + 1] - y[seg]) * frac])
+
+    max_tile = 2 ** zoom - 1
+    tiles = set()
+    span = int(np.ceil(corridor / tile_size))
+    # consecutive points mostly share their tile
+    tx = np.floor(x / tile_size).astype(np.int64)
+    ty = np.floor(y / tile_size).astype(np.int64)
+    x_min = tx.min()
+    y_min = ty.min()
+    rows = ty.max() - y_min + 1
+    tx, ty = np.divmod(np.unique((tx - x_min) * rows + ty - y_min), rows)
+    tx += x_min
+    ty += y_min
+    for dx in range(-span, span + 1):
+        for dy in range(-span, span + 1):
+            cx = np.clip(tx + dx, 0, max_tile)
+            cy = np.clip(ty + dy, 0, max_tile)
+            tiles.update(zip([zoom] * len(cx), cx.tolist(), cy.tolist()))
+    return tiles
+
+def bbox_tiles(bb, zoom, tile_size=256):
+    """Set of (zoom, x, y) tiles covering a ((lon1, lat1), (lon2, lat2))
+    bounding box"""
+    (lon1, lat1), (lon2, lat2) = bb
+    x, y = world_pixels([lon1, lon2], [lat1, lat2], zoom, tile_size)
+    max_tile = 2 ** zoom - 1
+    x1, x2 = sorted(np.clip(np.floor(x / tile_size).astype(int), 0, max_tile).tolist())
+    y1, y2 = sorted(np.clip(np.floor(y / tile_size).astype(int), 0, max_tile).tolist())
+    return { (zoom, tx, ty) for tx in range(x1, x2 + 1) for ty in range(y1, y2 + 1) }
+
+async def prefetch_tiles(store, urls, num_workers, downloader=None, batch_size=500):
+    """Download all urls missing in store with at most num_workers
+    requests in flight. Returns the number of (cached, fetched, failed)
+    tiles. The store is used on the default executor, so redis or SQLite
+    never block the event loop."""
+    if downloader is None:
+        downloader = fetch_tiles
+    loop = asyncio.get_event_loop()
+    missing = await loop.run_in_executor(None, lambda: [url for url in urls if not store.has(url)])
+    cached = len(urls) - len(missing)
+    fetched = failed = 0
+    for idx in range(0, len(missing), batch_size):
+        tiles = [Tile(url, None, None, None) for url in missing[idx:idx + batch_size]]
+        async for tile in downloader(tiles, num_workers):
+            if tile.img is None:
+                failed += 1
+            else:
+                await loop.run_in_executor(None, store.set, tile.url, tile.img)
+                fetched += 1
+        logging.getLogger(__name__).info("%d of %d missing tiles fetched" % (fetched + failed, len(missing)))
+    return cached, fetched, failed
+
+def image_surface(image):
+    """PIL image as Cairo ARGB32 surface. Cairo expects premultiplied
+    alpha in native byte order, which PIL packs directly as BGRa."""
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    width, height = image.size
+    buff = bytearray(image.tobytes("raw", "BGRa"))
+    return cairo.ImageSurface.create_for_data(buff, cairo.FORMAT_ARGB32, width, height, width * 4)
+
+def decode_tile(data):
+    """PNG or JPEG tile data as Cairo surface"""
+    return image_surface(PIL.Image.open(BytesIO(data)))
+
+@lru_cache(maxsize=4)
+def error_tile(width, height):
+    """Placeholder for tiles that failed to download"""
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(224 / 255, 224 / 255, 224 / 255)
+    cr.paint()
+    return surface
+
+def map_surface(size, surface=None):
+    """surface if it has the given size, otherwise a new one"""
+    width, height = size
+    if surface is None or (surface.get_width(), surface.get_height()) != (width, height):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    return surface
+
+def render_tiles(map_tile, tiles, surface=None):
+    """Paint decoded tiles into a map surface. Tiles cover the whole map,
+    so a surface of the right size is reused without clearing it."""
+    provider = map_tile.provider
+    surface = map_surface(map_tile.size, surface)
+    cr = cairo.Context(surface)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    for tile in tiles:
+        img = tile.img if tile.img is not None else error_tile(provider.tile_width, provider.tile_height)
+        x, y = tile.offset
+        cr.set_source_surface(img, x, y)
+        cr.rectangle(x, y, img.get_width(), img.get_height())
+        cr.fill()
+    return surface
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import calendar
+import dateutil.parser as parser
+import logging
+import sys
+
+from triptools import config
+from triptools import DB
+from triptools import osm_mapper
+
+logging.basicConfig(level=logging.INFO)
+
+def parse_ts(ts):
+    """Convert a timestamp into a time_t"""
+    dt = parser.parse(ts)
+    return calendar.timegm(dt.utctimetuple())
+
+def get_tiles(db, source, min_zoom, max_zoom):
+    corridor = config.getint("Prefetch", "corridor")
+    if source == "track":
+        track = db.fetch_trackpoints(parse_ts(config.get("Track", "start")),
+                                     parse_ts(config.get("Track", "end")))
+        return osm_mapper.track_tiles(track, min_zoom, max_zoom, corridor)
+    elif source == "video":
+        track = db.fetch_videopoints(db.get_video_ids(config.get("Video", "mask")))
+        return osm_mapper.track_tiles(track, min_zoom, max_zoom, corridor)
+    elif source == "bbox":
+        lon1, lat1, lon2, lat2 = map(float, config.get("Prefetch", "bbox").split(","))
+        return osm_mapper.bb_tiles(((lon1, lat1), (lon2, lat2)), min_zoom, max_zoom)
+    raise Exception("Unknown prefetch source '%s'" % source)
+
+if __name__ == "__main__":
+
+    try:
+        with DB() as db:
+            tiles = get_tiles(db,
+                              config.get("Prefetch", "source"),
+                              config.getint("Prefetch", "min_zoom"),
+                              config.getint("Prefetch", "max_zoom"))
+
+        if len(tiles) > config.getint("Prefetch", "max_tiles"):
+            raise Exception("%d tiles exceed prefetch_max_tiles" % len(tiles))
+        logging.getLogger(__name__).info("Prefetching %d tiles", len(tiles))
+
+        cached, fetched, failed = osm_mapper.prefetch(tiles, config.getint("Prefetch", "requests"))
+        logging.getLogger(__name__).info("%d tiles cached already, %d fetched, %d failed", cached, fetched, failed)
+
+    except Exception as e:
+        logging.getLogger(__name__).error(e, exc_info=True)
+        sys.exit(1)
@@ -77,10 +77,9 @@ def make_trackmap(db, num, start_time, end_time, center, radius, track_name):
                                      config.getfloat("Map", "marg_pct"),
                                      config.getfloat("Map", "marg_km"))
 
-    map_tile, image = osm_mapper.get_map_from_bb(bb,
-                                                 (config.getint("Map", "width"),
-                                                  config.getint("Map", "height")))
-    surface = osm_mapper.as_surface(image)
+    map_tile, surface = osm_mapper.get_map_from_bb(bb,
+                                                   (config.getint("Map", "width"),
+                                                    config.getint("Map", "height")))
     osm_mapper.draw_trackpoints(map_tile, surface, track)
     
     
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+from imageio.plugins import ffmpeg
+import os
+import shutil
+import struct
+import subprocess
+
+logging.basicConfig(level=logging.INFO)
+
+def ffprobe_exe():
+    """ffprobe next to the ffmpeg binary or in PATH"""
+    ffmpeg_exe = ffmpeg.get_exe()
+    candidate = os.path.join(os.path.dirname(ffmpeg_exe),
+                             os.path.basename(ffmpeg_exe).replace("ffmpeg", "ffprobe"))
+    if os.access(candidate, os.X_OK):
+        return candidate
+    candidate = shutil.which("ffprobe")
+    if candidate is None:
+        raise Exception("ffprobe not found")
+    return candidate
+
+def fetch_keyframes(filename):
+    """List of (timestamp, byte offset) of all keyframes of the first
+    video stream. Only packet headers are read, nothing is decoded."""
+    args = [ffprobe_exe(), "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,pos,flags",
+            "-of", "compact=p=0",
+            filename]
+    keyframes = []
+    with subprocess.Popen(args, stdout=subprocess.PIPE) as job:
+        for line in job.stdout:
+            fields = dict(f.split("=", 1) for f in line.decode("ascii", "ignore").strip().split("|") if "=" in f)
+            if "K" in fields.get("flags", "") and fields.get("pts_time", "N/A") != "N/A":
+                pos = fields.get("pos", "N/A")
+                keyframes.append((float(fields["pts_time"]), int(pos) if pos != "N/A" else None))
+    if job.returncode != 0:
+        raise Exception("Failed to fetch keyframes of %s" % filename)
+    keyframes.sort()
+    return keyframes
+
+def find_moov(filename):
+    """(offset, size) of the moov box of an MP4 file or None. Only the
+    headers of the top level boxes are read."""
+    with open(filename, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, kind = struct.unpack(">I4s", header[:8])
+            if size == 1 and len(header) == 16:
+                # 64 bit size follows the type
+                size = struct.unpack(">Q", header[8:])[0]
+            elif size == 0:
+                # box extends to the end of the file
+                size = file_size - offset
+            if kind == b"moov":
+                return offset, size
+            if size < 8:
+                break
+            offset += size
+    return None
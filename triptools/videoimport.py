@@ -15,6 +15,7 @@ import types
 from triptools import config
 from triptools import DB
 from triptools.common import get_names, parse_datetime
+from triptools.video_support import fetch_keyframes, find_moov
 
 logging.basicConfig(level=logging.INFO)
 
@@ -120,7 +121,10 @@ def import_videopoints(db, filename):
         video = db.get_video(filename)
         if video and not config.getboolean("Video", "refresh"):
             logging.getLogger(__name__).info("Video %s already imported" % filename)
-            return
+            if not db.has_video_index(video["id"]):
+                # imported before keyframes were recorded
+                import_video_index(db, filename, video["id"])
+            return 0
 
         duration = fetch_duration(filename)
 
@@ -138,10 +142,23 @@ def import_videopoints(db, filename):
                 traceback.print_exc()
 
     logging.getLogger(__name__).info("file '%s' imported, %d videopoints added to DB" % (filename, count))
+    import_video_index(db, filename, video_id)
+    return count
+
+def import_video_index(db, filename, video_id):
+    """Keyframes and moov location, so videoserve can start streams at a
+    keyframe without the browser probing the file"""
+    try:
+        keyframes = fetch_keyframes(filename)
+        db.set_video_index(video_id, find_moov(filename), keyframes)
+        logging.getLogger(__name__).info("file '%s' indexed, %d keyframes" % (filename, len(keyframes)))
+    except Exception as e:
+        logging.getLogger(__name__).warning("No keyframe index for %s: %s" % (filename, e))
             
 if __name__ == "__main__":
 
     db = DB()
+    added = 0
 
     for filename in get_names(config.get("Video", "name"), config.get("Video", "mask")):
         try:
@@ -149,8 +166,12 @@ if __name__ == "__main__":
             if not os.access(filename, os.R_OK):
                 raise Exception("cannot read video file '%s'" % filename)
 
-            import_videopoints(db, filename)
+            added += import_videopoints(db, filename)
         
         except Exception as e:
             logging.getLogger(__name__).error(e, exc_info=True)
             logging.getLogger(__name__).debug(e, exc_info=True)
+
+    if added:
+        # makes videoserve reload its videos
+        db.bump_data_version("videos")
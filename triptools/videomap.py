@@ -22,10 +22,9 @@ def make_videomap(mask):
                                      config.getfloat("Map", "marg_pct"),
                                      config.getfloat("Map", "marg_km"))
 
-    map_tile, image = osm_mapper.get_map_from_bb(bb,
-                                                 (config.getint("Map", "width"),
-                                                  config.getint("Map", "height")))
-    surface = osm_mapper.as_surface(image)
+    map_tile, surface = osm_mapper.get_map_from_bb(bb,
+                                                   (config.getint("Map", "width"),
+                                                    config.getint("Map", "height")))
     osm_mapper.draw_trackpoints(map_tile, surface, track)
     target = config.get("Map", "target")
     surface.write_to_png(target)
@@ -2,21 +2,27 @@
 # -*- coding: utf-8 -*-
 
 from functools import lru_cache
+from imageio.plugins import ffmpeg
 import logging
 import mimetypes
 import os
-import re
+import subprocess
 import sys
+import threading
 
-from flask import Flask, request, Response, render_template, make_response, send_file
+from flask import Flask, request, Response, abort, jsonify, render_template
 from werkzeug.routing import FloatConverter as BaseFloatConverter
-from gevent.wsgi import WSGIServer
 
 from triptools import config
 from triptools import DB
 from triptools import osm_mapper
-from triptools.common import Track, Trackpoint, distance
+from triptools.map_support import TrackLevels, TrackRegions
+from triptools.cache_support import DataVersion, make_key
+from triptools.common import Track, Trackpoint
 from triptools.configuration import MOVIE_PROFILE_PREFIX
+from triptools.range_support import FileHandles, parse_ranges, range_response
+from triptools.serve_support import heavy, serve
+from triptools.web_support import conditional_response, file_response, get_rendered_tile, map_key, render_cache, tile_key
 
 logging.basicConfig(level=logging.INFO)
 
@@ -36,37 +42,94 @@ def setup_app():
 SIZE = None
 name_mask = None
 db = None
-videos = None
-track_points = None
+catalogue = None
+cache = None
+# open video files
+files = None
+# slots for remuxing ffmpeg processes
+streams = None
 
 app = setup_app()
+
+class VideoCatalogue:
+    """Videos of the mask with an overview of their tracks. Full
+    resolution tracks are loaded by region for zoomed in maps. Reloaded
+    when videoimport changed the videos."""
+
+    def __init__(self, db, name_mask, version):
+        self.db = db
+        self.name_mask = name_mask
+        self.version = version
+        self.loaded = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Reload if the videos changed, returns the catalogue"""
+        version = self.version.get()
+        with self.lock:
+            if version != self.loaded:
+                self.load(version)
+        return self
+
+    def load(self, version):
+        web_conf = config["Webserver"]
+        video_ids = self.db.get_video_ids(self.name_mask)
+        videos = {id: self.db.get_video_by_id(id) for id in video_ids}
+        overview_points = self.db.fetch_video_overview(video_ids, web_conf.getint("overview_interval"))
+        regions = TrackRegions(lambda *bb: self.db.fetch_videopoints_bb(video_ids, *bb),
+                               max(web_conf.getint("detail_zoom") - 2, 0),
+                               web_conf.getint("track_regions"))
+        self.videos = videos
+        self.overview_points = overview_points
+        self.overview = TrackLevels(overview_points)
+        self.regions = regions
+        # identifies the served videos, part of all map ETags and cache keys
+        self.key = make_key(self.name_mask, version, video_ids)
+        self.loaded = version
+        logging.getLogger(__name__).info("Serving %d videos, %d overview points" % (len(videos), len(overview_points)))
+
 @app.after_request
 def after_request(response):
-    response.headers.add('Accept-Ranges', 'bytes')
+    # streams are remuxed on the fly and cannot serve ranges
+    if request.endpoint != "stream":
+        response.headers.add('Accept-Ranges', 'bytes')
     return response
 
 def part(lon, lat, zoom):
     return "/%f/%f/%d" % (lon, lat, zoom)
 
-@lru_cache(maxsize=1024)
-def get_rendered_png(lon, lat, zoom):
+def map_for(lon, lat, zoom):
+    """Map of a page without rendering it, a negative zoom shows all tracks"""
     if zoom < 0:
-        bb = osm_mapper.get_bounding_box(track_points,
+        bb = osm_mapper.get_bounding_box(catalogue.overview_points,
                                          config.getfloat("Map", "marg_pct"),
                                          config.getfloat("Map", "marg_km"))
-        map_tile, image = osm_mapper.get_map_from_bb(bb, SIZE)
+        return osm_mapper.bb_map(bb, SIZE)
+    return osm_mapper.centered_map(lon, lat, zoom, SIZE)
+
+def draw_tracks(map_tile, surface):
+    """Overview of the tracks, full resolution tracks from detail_zoom on"""
+    if map_tile.zoom < config.getint("Webserver", "detail_zoom"):
+        osm_mapper.draw_track(map_tile, surface, catalogue.overview)
     else:
-        map_tile, image = osm_mapper.get_centered_map(lon, lat, zoom, SIZE)
-    surface = osm_mapper.as_surface(image)
-    osm_mapper.draw_trackpoints(map_tile, surface, track_points)
-    data = surface.write_to_png()
+        osm_mapper.draw_regions(map_tile, surface, catalogue.regions)
 
-    return map_tile, data
+def get_rendered_png(lon, lat, zoom):
+
+    @heavy
+    def render():
+        map_tile = map_for(lon, lat, zoom)
+        surface = osm_mapper.render_map(map_tile)
+        draw_tracks(map_tile, surface)
+        return surface.write_to_png()
+
+    return cache.cached(map_key(catalogue.refresh().key, SIZE, lon, lat, zoom), render)
 
 @app.route('/', defaults={"lon" : 0.0, "lat" : 0, "zoom" : -1})
 @app.route('/<float:lon>/<float:lat>/<int:zoom>')
 def root(lon, lat, zoom):
-    map_tile, _ = get_rendered_png(lon, lat, zoom)
+    map_tile = map_for(lon, lat, zoom)
     lon1, lat1, lon2, lat2 = map_tile.extent
     lon, lat = map_tile.geocode((int(SIZE[0]/2), int(SIZE[1]/2)))
     zoom = map_tile.zoom
@@ -79,38 +142,43 @@ def root(lon, lat, zoom):
                            left=part(lon - h_step, lat, zoom),
                            right=part(lon + h_step, lat, zoom),
                            zoom_in=part(lon, lat, zoom + 1),
-                           zoom_out=part(lon, lat, zoom -1))
+                           zoom_out=part(lon, lat, zoom -1),
+                           map_etag=map_key(catalogue.refresh().key, SIZE, lon, lat, zoom))
 
 @app.route("/<float:lon>/<float:lat>/<int:zoom>/map.png")
 def map(lon, lat, zoom):
-    map_tile, data = get_rendered_png(lon, lat, zoom)
-    resp = make_response(data, 200, { "content-type" : "image/png" })
-    return resp
+    return conditional_response(map_key(catalogue.refresh().key, SIZE, lon, lat, zoom),
+                                lambda: get_rendered_png(lon, lat, zoom),
+                                "image/png")
+
+@app.route("/tiles/<int:zoom>/<int:x>/<int:y>.png")
+def tile(zoom, x, y):
+    if not osm_mapper.valid_tile(zoom, x, y):
+        abort(404)
+    return conditional_response(tile_key(catalogue.refresh().key, zoom, x, y),
+                                lambda: get_rendered_tile(cache, catalogue.refresh().key, zoom, x, y, draw_tracks),
+                                "image/png",
+                                config.getint("Webserver", "tile_max_age"))
 
 def get_video(id):
-    for video in videos:
-        if video["id"] == id:
-            return video
-    raise Exception("Invalid video id '%s'" % id)
+    try:
+        return catalogue.videos[id]
+    except KeyError:
+        raise Exception("Invalid video id '%s'" % id)
 
 @app.route('/play/<float:lon>/<float:lat>/<int:zoom>', methods=["GET", "POST"])
 def play(lon, lat, zoom):
 
     def get_closest(lon, lat):
-        best = track_points[0]
-        best_dist = distance(lon, lat, best.longitude, best.latitude)
-        for idx in range(1, len(track_points)):
-            tp = track_points[idx]
-            new_dist = distance(lon, lat, tp.longitude, tp.latitude)
-            if new_dist < best_dist:
-                best = tp
-                best_dist = new_dist
+        best = db.get_closest_videopoint(lon, lat, list(catalogue.videos))
+        if best is None:
+            abort(404)
         video = get_video(best.video_id)
         return video, best.timestamp, best.timestamp - video["starttime"]
     
     x = int(request.form["img.x"])
     y = int(request.form["img.y"])
-    map_tile, data = get_rendered_png(lon, lat, zoom)
+    map_tile = map_for(lon, lat, zoom)
     lon, lat = map_tile.geocode((x,y))
     video, timestamp, offset = get_closest(lon, lat)
     fname = video["filename"]
@@ -118,6 +186,10 @@ def play(lon, lat, zoom):
 
     url = "/sendvid/" + str(video["id"]) + "/%d/vid" % offset + ext + "#t=%d,%d" % (offset, video["duration"])
     type = mimetype=mimetypes.guess_type(fname)[0] 
+    start = stream_start(video, offset)
+    if start is not None:
+        url = "/stream/%d/%.3f/vid.mp4#t=%.3f,%d" % (video["id"], start, offset - start, video["duration"] - start)
+        type = "video/mp4"
     return render_template("video.jinja2", url=url, type=type)
 
 @lru_cache(maxsize=100)
@@ -131,48 +203,87 @@ def check_map(filename):
     logging.getLogger(__name__).warning("Sending video %s" % filename)
     return filename
 
+def stream_start(video, offset):
+    """Time of the keyframe a stream of video playing from offset seconds
+    starts at, None if the byte range URL starts as fast or the video is
+    not an MP4/MOV file"""
+    if check_map(video["filename"]) != video["filename"]:
+        # the index is of the original, not of the movie with the map
+        return None
+    moov = db.get_video_moov(video["id"])
+    if moov is None:
+        # other containers may hold codecs MP4 or the browser cannot play
+        return None
+    keyframe = db.get_keyframe(video["id"], offset)
+    if keyframe is None:
+        return None
+    pts, pos = keyframe
+    if pts == 0 and pos is not None and moov[0] < pos:
+        # playing from the start needs no probing if moov comes first
+        return None
+    return pts
+
+@app.route("/stream/<int:id>/<float:start>/<path:path>")
+def stream(id, start, path=None):
+    """Fragmented MP4 of a video from its keyframe at start seconds on,
+    remuxed without reencoding. The browser can play it as it arrives,
+    without range requests for the moov box and the keyframe. At most
+    webserver_streams run at the same time, more are answered with 503."""
+    filename = get_video(id)["filename"]
+    if not streams.acquire(blocking=False):
+        abort(503)
+    args = [ffmpeg.get_exe(), "-loglevel", "error",
+            "-ss", "%.3f" % start, "-i", filename,
+            "-map", "0:v:0", "-map", "0:a?", "-c", "copy",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4", "pipe:1"]
+    try:
+        job = subprocess.Popen(args, stdout=subprocess.PIPE)
+    except Exception:
+        streams.release()
+        raise
+    chunk = config.getint("Webserver", "stream_chunk_size")
+    stopped = []
+
+    def stop():
+        """Called when the response is closed, also if the client went
+        away before or while reading"""
+        if not stopped:
+            stopped.append(True)
+            job.kill()
+            job.wait()
+            streams.release()
+
+    def remux():
+        try:
+            while True:
+                data = job.stdout.read1(chunk)
+                if not data:
+                    break
+                yield data
+        finally:
+            stop()
+
+    rv = Response(remux(), mimetype="video/mp4", direct_passthrough=True)
+    rv.call_on_close(stop)
+    return rv
+
 @app.route("/sendvid/<int:id>/<int:offset>/<path:path>", methods=["GET"])
 def sendvid(id, offset, path=None):
 
-    def stream_file(filename, start, length):
-        with open(filename, 'rb') as f:
-            offset = 0
-            while offset < length:
-                f.seek(start + offset)
-                chunk = config.getint("Webserver", "chunk_size")
-                if offset + chunk > length:
-                    chunk = length - offset
-                offset += chunk
-                yield f.read(chunk)
-    
     video = get_video(id)
     filename = check_map(video["filename"])
-    range_header = request.headers.get('Range', None)
-
-    if not range_header:
-        return send_file(filename)
-    
-    size = os.path.getsize(filename)    
-    byte1, byte2 = 0, None
-    
-    m = re.search('(\d+)-(\d*)', range_header)
-    g = m.groups()
-    
-    if g[0]: byte1 = int(g[0])
-    if g[1]: byte2 = int(g[1])
+    ranges = parse_ranges(request.headers.get("Range"), os.path.getsize(filename))
+    if ranges is None:
+        return file_response(filename, config.getint("Webserver", "file_max_age"))
 
-    length = size - byte1
-    if byte2 is not None:
-        length = min(byte2 - byte1 + 1, length)
+    return range_response(files, filename, ranges,
+                          mimetypes.guess_type(path)[0] or "application/octet-stream",
+                          config.getint("Webserver", "chunk_size"))
 
-    rv = Response(stream_file(filename, byte1, length),
-        206,
-        mimetype=mimetypes.guess_type(path)[0], 
-        direct_passthrough=True)
-    rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
-
-    return rv
-    
+@app.route("/stats")
+def stats():
+    return jsonify(render=cache.stats(), files=files.stats(), tracks=catalogue.regions.stats(), **osm_mapper.stats())
 
 if __name__ == "__main__":
 
@@ -180,17 +291,15 @@ if __name__ == "__main__":
         SIZE = (config.getint("Webserver", "map_width"),
                 config.getint("Webserver", "map_height"))
         name_mask = config.get("Video", "mask")
+        cache = render_cache()
+        files = FileHandles(config.getint("Webserver", "open_files"))
+        streams = threading.BoundedSemaphore(config.getint("Webserver", "streams"))
         with DB() as db:
-            video_ids = db.get_video_ids(name_mask)
-            videos = [ db.get_video_by_id(id) for id in video_ids]
-            track_points = db.fetch_videopoints(video_ids)
-
-            http_server = WSGIServer((config.get("Webserver", "interface"), config.getint("Webserver", "port")), app)
-            http_server.serve_forever()
-            
-#            app.run(host=config.get("Webserver", "interface"),
-#                    port=config.getint("Webserver", "port"))
-            
+            catalogue = VideoCatalogue(db, name_mask,
+                                       DataVersion(db, "videos", config.getint("Webserver", "data_version_check")))
+
+            serve(app)
+
     except Exception as e:
         logging.getLogger(__name__).error(e)
         sys.exit(1)
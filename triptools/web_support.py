@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import calendar
+
+from flask import Response, make_response, request, send_file
+import redis
+
+from triptools import config
+from triptools import osm_mapper
+from triptools.cache_support import RenderCache, make_key
+from triptools.serve_support import heavy
+
+# for URLs which change whenever their content changes
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+def not_modified(etag, last_modified=None):
+    """True if the client already has the version etag or a copy not
+    older than last_modified (time_t)"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return (last_modified is not None and since is not None
+            and int(last_modified) <= calendar.timegm(since.utctimetuple()))
+
+
+def conditional_response(etag, make_body, mimetype, max_age=0, last_modified=None):
+    """Response with validators for the content version etag. make_body
+    is only called if the client does not have this version already. If
+    the request names the version in its v argument, the response may be
+    cached forever."""
+    if not_modified(etag, last_modified):
+        resp = Response(status=304)
+    else:
+        resp = make_response(make_body())
+        resp.mimetype = mimetype
+    resp.set_etag(etag)
+    if last_modified is not None:
+        resp.last_modified = int(last_modified)
+    if request.args.get("v") == etag:
+        resp.headers["Cache-Control"] = IMMUTABLE
+    else:
+        resp.headers["Cache-Control"] = "public, max-age=%d" % max_age
+    return resp
+
+
+def file_response(filename, max_age, etag=None, mimetype=None, immutable=False):
+    """File with 304 handling. The ETag is derived from mtime and size
+    unless given. immutable is for URLs addressing the content, e.g. by
+    its hash."""
+    resp = send_file(filename, mimetype=mimetype, conditional=True, etag=etag if etag else True)
+    if immutable or (etag and request.args.get("v") == etag):
+        resp.headers["Cache-Control"] = IMMUTABLE
+    else:
+        resp.headers["Cache-Control"] = "public, max-age=%d" % max_age
+    return resp
+
+
+def map_etag(version, *key):
+    """ETag and cache key of data shown on a map. version identifies the
+    data drawn on top of the map."""
+    return make_key(version, osm_mapper.provider.url, *key)
+
+
+def map_key(version, size, lon, lat, zoom):
+    return map_etag(version, "map", size, "%f" % lon, "%f" % lat, zoom)
+
+
+def tile_key(version, zoom, x, y):
+    return map_etag(version, "tile", zoom, x, y)
+
+
+def get_rendered_tile(cache, version, zoom, x, y, draw):
+    """PNG of tile zoom/x/y with draw(map_tile, surface) on top"""
+
+    @heavy
+    def render():
+        map_tile, surface = osm_mapper.get_tile_map(zoom, x, y)
+        draw(map_tile, surface)
+        return surface.write_to_png()
+
+    return cache.cached(tile_key(version, zoom, x, y), render)
+
+
+def render_cache():
+    """RenderCache configured in the Webserver section"""
+    host = config.get("Webserver", "render_cache_redis")
+    return RenderCache(config.getfloat("Webserver", "render_cache_mb"),
+                       config.getint("Webserver", "render_cache_ttl"),
+                       redis.Redis(host) if host else None)